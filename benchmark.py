@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+Reproducible benchmarks for the platformer. Each scenario builds a synthetic
+level from a seed, steps App.update and App.draw headless for a fixed number
+of frames and reports the time spent in each phase of the loop (ns/frame) and
+the memory allocated per frame as JSON. Two result files can be compared to
+flag phases that got slower.
+
+    python benchmark.py run -o before.json
+    python benchmark.py run -o after.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py allocations
+
+Scenarios walk a scripted path by default; --replay times a session
+recorded with main.py --record instead.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import pygame as pg
+
+import main
+
+
+FRAMES = 600
+WARMUP_FRAMES = 60
+REGRESSION_THRESHOLD = 0.10  # flag phases more than 10% slower
+PLATFORM_COLORS = ((100, 100, 200), (200, 100, 100), (100, 200, 100))
+
+TILE_SIZE = (20, 10)
+
+# every scenario starts from DEFAULT_CONFIG; tiled levels are built from
+# TILE_SIZE pieces and platforms is then the number of ledges
+DEFAULT_CONFIG = {
+    "platforms": 2,
+    "entities": 0,
+    "width": main.VIRTUAL_SCREEN_SIZE[0],
+    "tiled": False,
+    "overlay": True,
+    "dirty_rects": False,
+    "static_layer": False,
+    "entity_store": False,
+    "atlas": False,
+}
+SCENARIOS = {
+    "default": {},
+    "no_overlay": {"overlay": False},
+    "wide_level": {"platforms": 5000, "width": 200000, "overlay": False},
+    "dense_level": {"platforms": 2000, "width": 4000, "overlay": False},
+    "tiled_level": {"platforms": 400, "width": 20000, "tiled": True, "overlay": False},
+    "crowd": {"platforms": 200, "entities": 50, "width": 4000, "overlay": False},
+    "dirty_rects": {"platforms": 200, "entities": 5, "width": 4000, "dirty_rects": True},
+    "static_layer": {"platforms": 2000, "entities": 5, "width": 4000, "static_layer": True},
+    "atlas": {"platforms": 2000, "entities": 5, "width": 4000, "overlay": False, "atlas": True},
+}
+if main.np is not None:
+    SCENARIOS["crowd_entity_store"] = dict(SCENARIOS["crowd"], entity_store=True)
+
+
+def synthetic_level(platforms, width, seed):
+    """
+    A floor across the whole level plus platforms scattered above it.
+    """
+    rng = random.Random(seed)
+    height = main.SCREEN_SIZE[1]
+    level = [((width, 10), (0, height - 10), PLATFORM_COLORS[0])]
+    for _ in range(platforms - 1):
+        size = (rng.randrange(20, 200), 10)
+        position = (rng.randrange(0, max(width - size[0], 1)), rng.randrange(100, height - 40))
+        level.append((size, position, rng.choice(PLATFORM_COLORS)))
+    return level
+
+
+def tiled_level(ledges, width, seed):
+    """
+    A two tile deep floor and ledges, all made of separate TILE_SIZE tiles.
+    """
+    rng = random.Random(seed)
+    tile_w, tile_h = TILE_SIZE
+    height = main.SCREEN_SIZE[1]
+    level = []
+    for y in (height - 2 * tile_h, height - tile_h):
+        for x in range(0, width, tile_w):
+            level.append((TILE_SIZE, (x, y), PLATFORM_COLORS[0]))
+    for _ in range(ledges):
+        x = rng.randrange(0, max(width // tile_w - 10, 1)) * tile_w
+        y = rng.randrange(10, (height - 40) // tile_h) * tile_h
+        color = rng.choice(PLATFORM_COLORS)
+        for n in range(rng.randrange(3, 10)):
+            level.append((TILE_SIZE, (x + n * tile_w, y), color))
+    return level
+
+
+def scripted_inputs(frames, seed):
+    """
+    Walk right and left in bursts, jumping now and then.
+    """
+    rng = random.Random(seed)
+    inputs = []
+    direction = pg.K_RIGHT
+    for frame in range(frames):
+        if frame % 90 == 0:
+            direction = rng.choice((pg.K_RIGHT, pg.K_LEFT, None))
+        keys = set()
+        if direction is not None:
+            keys.add(direction)
+        if rng.random() < 0.05:
+            keys.add(pg.K_SPACE)
+        inputs.append(main.ScriptedKeys(keys))
+    return inputs
+
+
+def scenario_config(name):
+    return dict(DEFAULT_CONFIG, **SCENARIOS[name])
+
+
+def build_app(config, seed):
+    make_level = tiled_level if config["tiled"] else synthetic_level
+    app = main.App(dirty_rects=config["dirty_rects"],
+                   level=make_level(config["platforms"], config["width"], seed),
+                   static_layer=config["static_layer"], entity_store=config["entity_store"],
+                   atlas=config["atlas"])
+    app.show_overlay = config["overlay"]
+    rng = random.Random(seed + 1)
+    for _ in range(config["entities"]):
+        position = main.vector(rng.randrange(0, main.SCREEN_SIZE[0]), rng.randrange(0, 300))
+        app.add_actor(main.Player(app, position, main.SPRITE_SIZE, (255, 0, 0), main.SPRITE_VELOCITY))
+    return app
+
+
+def run_frames(app, inputs):
+    for keys in inputs:
+        app.step(keys)
+        app.draw()
+
+
+def time_scenario(config, frames, warmup, seed, inputs=None):
+    """
+    Mean ns/frame of every phase recorded by the App's profiler. Entity
+    updates are summed per entity class.
+    """
+    app = build_app(config, seed)
+    inputs = inputs or scripted_inputs(warmup + frames, seed)
+    run_frames(app, inputs[:warmup])
+    profiler = app.profiler
+    profiler.enabled = True
+    totals = {}
+    frame_ns = 0
+    for keys in inputs[warmup:]:
+        profiler.clear()
+        start = time.perf_counter_ns()
+        app.step(keys)
+        app.draw()
+        frame_ns += time.perf_counter_ns() - start
+        for name, _, duration in profiler.samples():
+            totals[name] = totals.get(name, 0) + duration
+    app.close()
+    phases = dict((name, total / frames) for name, total in sorted(totals.items()))
+    phases["frame"] = frame_ns / frames
+    return phases
+
+
+def measure_allocations(config, frames, warmup, seed, inputs=None):
+    """
+    Bytes allocated and then freed within a frame, and the net number of
+    memory blocks each frame leaves behind, both averaged over frames.
+    """
+    app = build_app(config, seed)
+    inputs = inputs or scripted_inputs(warmup + frames, seed)
+    run_frames(app, inputs[:warmup])
+    tracemalloc.start()
+    transient = 0
+    blocks = sys.getallocatedblocks()
+    for keys in inputs[warmup:]:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        app.step(keys)
+        app.draw()
+        transient += tracemalloc.get_traced_memory()[1] - current
+    blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    app.close()
+    return {
+        "transient_bytes_per_frame": transient / frames,
+        "net_blocks_per_frame": blocks / frames,
+    }
+
+
+def player_allocations(ticks, warmup=WARMUP_FRAMES, seed=0):
+    """
+    Net bytes still allocated from main.py after each of two successive
+    windows of ticks ticks stepping the player in steady state. A single
+    window can end a few bytes up or down depending on what Python's free
+    lists happen to hold, so only growth in both counts as a leak.
+    """
+    app = build_app(scenario_config("default"), seed)
+    player = app.player
+    dt = 1.0 / app.tick_rate
+    inputs = scripted_inputs(warmup + 2 * ticks, seed)
+    for keys in inputs[:warmup]:
+        player.update(keys, app.screen_rect, app.camera, dt)
+    only_main = [tracemalloc.Filter(True, main.__file__)]
+    tracemalloc.start()
+    snapshots = [tracemalloc.take_snapshot().filter_traces(only_main)]
+    for start in (warmup, warmup + ticks):
+        for keys in inputs[start:start + ticks]:
+            player.update(keys, app.screen_rect, app.camera, dt)
+        snapshots.append(tracemalloc.take_snapshot().filter_traces(only_main))
+    tracemalloc.stop()
+    app.close()
+    return [sum(stat.size_diff for stat in after.compare_to(before, "lineno"))
+            for before, after in zip(snapshots, snapshots[1:])]
+
+
+def run(names, frames, warmup, seed, replay=None):
+    """
+    Run the scenarios named, each fed the same recorded inputs when replay
+    is the path of a recording, in which case frames is however many it
+    holds after warmup.
+    """
+    main.init_headless()
+    inputs = None
+    if replay:
+        # the scenarios build their own worlds, so only the inputs are used
+        _, inputs = main.load_replay(replay, check_level=False)
+        frames = len(inputs) - warmup
+        if frames <= 0:
+            raise ValueError("%s holds no more than %d warmup ticks" % (replay, warmup))
+    results = {}
+    for name in names:
+        config = scenario_config(name)
+        result = {
+            "config": config,
+            "frames": frames,
+            "seed": seed,
+            "ns_per_frame": time_scenario(config, frames, warmup, seed, inputs),
+        }
+        if replay:
+            result["replay"] = replay
+        result.update(measure_allocations(config, frames, warmup, seed, inputs))
+        results[name] = result
+        print("%-20s %10.0f ns/frame" % (name, result["ns_per_frame"]["frame"]), file=sys.stderr)
+    pg.quit()
+    return {"pygame": pg.version.ver, "python": sys.version.split()[0], "scenarios": results}
+
+
+def compare(before, after, threshold=REGRESSION_THRESHOLD):
+    """
+    (scenario, phase, before ns, after ns, change) for every phase measured
+    in both runs, and whether any of them is more than threshold slower.
+    """
+    rows = []
+    regressed = False
+    for name, result in sorted(after["scenarios"].items()):
+        if name not in before["scenarios"]:
+            continue
+        old_phases = before["scenarios"][name]["ns_per_frame"]
+        for phase, new in sorted(result["ns_per_frame"].items()):
+            old = old_phases.get(phase)
+            if not old:
+                continue
+            change = (new - old) / old
+            regressed = regressed or change > threshold
+            rows.append((name, phase, old, new, change))
+    return rows, regressed
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmark scenarios")
+    run_parser.add_argument("scenarios", nargs="*",
+                            help="scenarios to run, from %s (default: all)" % ", ".join(sorted(SCENARIOS)))
+    run_parser.add_argument("--frames", type=int, default=FRAMES)
+    run_parser.add_argument("--warmup", type=int, default=WARMUP_FRAMES)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--replay", metavar="PATH",
+                            help="feed a session recorded with main.py --record instead of scripted input")
+    run_parser.add_argument("-o", "--output", help="write the results here instead of stdout")
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    allocations_parser = commands.add_parser(
+        "allocations", help="check that Player.update allocates nothing in steady state")
+    allocations_parser.add_argument("--ticks", type=int, default=FRAMES)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        unknown = set(args.scenarios) - set(SCENARIOS)
+        if unknown:
+            parser.error("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+        results = run(args.scenarios or sorted(SCENARIOS), args.frames, args.warmup, args.seed,
+                      args.replay)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+        return 0
+
+    if args.command == "allocations":
+        main.init_headless()
+        first, second = player_allocations(args.ticks)
+        pg.quit()
+        print("Player.update: %d then %d bytes left allocated over two windows of %d ticks"
+              % (first, second, args.ticks))
+        return 1 if first > 0 and second > 0 else 0
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    rows, regressed = compare(before, after, args.threshold)
+    for name, phase, old, new, change in rows:
+        flag = "REGRESSION" if change > args.threshold else ""
+        print("%-20s %-18s %12.0f %12.0f %+7.1f%% %s" % (name, phase, old, new, change * 100, flag))
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -8,14 +8,33 @@ the actual time. They should be approximately the same and more importantly
 the same in any execution environment.
 """
 
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
 import os
+import queue
+import random
+import socket
+import struct
 import sys
 import time
 import pygame as pg
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 vector = pg.math.Vector2 
+log = logging.getLogger("platformer")
 
 
 CAPTION = "Platformer"
@@ -24,8 +43,49 @@ VIRTUAL_SCREEN_SIZE = (1000, 400)  # size of virtual screen for scrolling
 BACKGROUND_COLOR = (100, 200, 200)
 DEBUG_OVERLAY_SIZE = (300, 200)
 DEBUG_OVERLAY_BACKGROUND_COLOR = (0, 0, 0, 200)
+DEBUG_OVERLAY = True  # show the debug overlay, F3 toggles it
+DEBUG_OVERLAY_UPDATE_RATE = 10  # times per second the overlay text is refreshed
+DEBUG_TEXT_CACHE_SIZE = 64  # rendered lines kept before the oldest is dropped
 TRANSPARENT = (0, 0, 0, 0)
+FRAME_STATS_SIZE = 600  # frames in the rolling frame time window
+FRAME_STATS_BIN_MS = 0.25  # width of a frame time histogram bin
+FRAME_STATS_BINS = 400  # bins up to 100ms, anything slower lands in the last one
+DROPPED_FRAME_FACTOR = 1.5  # frames over this many frame budgets count as dropped
 FPS = 60  # CHANGE ME - to your preferred frame rate
+PHYSICS_TICK_RATE = 120  # fixed rate the simulation is stepped at
+PHYSICS_REFERENCE_RATE = 60  # rate the PLAYER_* and CAMERA_* constants were tuned for
+MAX_FRAME_TIME = 0.25  # never simulate more than this much time per frame
+MAX_TICKS_PER_FRAME = 10  # drop the backlog rather than spiral when a frame stalls
+DIRTY_RECTS = False  # only push the changed regions of the screen each frame
+ENTITY_STORE = False  # integrate all actors in one vectorized step, needs numpy
+ENTITY_STORE_CAPACITY = 64  # rows allocated up front, doubled when full
+STATIC_LAYER = False  # draw the background and static platforms from baked chunks
+STATIC_CHUNK_SIZE = 512  # world pixels per side of a baked chunk
+STATIC_CHUNK_CACHE_SIZE = 8  # baked chunks kept before the least recently drawn is dropped
+ATLAS = False  # pack the level's sprite images into a few shared pages
+ATLAS_PAGE_SIZE = (1024, 1024)
+PROFILE = False  # record loop timings from the start, F8 toggles and F9 exports
+PROFILE_BUFFER_SIZE = 20000  # timing samples kept, oldest are overwritten
+PROFILE_TRACE_PATH = "platformer_trace.json"
+INPUT_KEYS = (pg.K_LEFT, pg.K_RIGHT, pg.K_SPACE)  # keys the simulation reads, one bit each in a replay
+REPLAY_MAGIC = b"PREP"
+REPLAY_VERSION = 2
+REPLAY_DIGEST_SIZE = 8  # bytes of the hash of the level a replay was recorded on
+REPLAY_HEADER = struct.Struct("<4sHHI%ds" % REPLAY_DIGEST_SIZE)  # magic, version, tick rate, ticks, level
+SNAPSHOT_HISTORY = 120  # ticks of world state kept for rewind, 0 keeps none
+WORLD_STATE = struct.Struct("<qI")  # tick, actors
+CAMERA_STATE = struct.Struct("<5d")  # position, previous position, scroll
+# position, velocity, acceleration, previous position, rect x and y, direction, on platform
+ACTOR_STATE = struct.Struct("<10d2b")
+NET_PORT = 47000  # netplay player 0 listens here, player 1 on the next port
+NET_LATENCY = 0.0  # seconds every packet sent is held back, for testing
+NET_LOSS = 0.0  # fraction of packets sent that are dropped, for testing
+NET_MAX_PACKET = 2048
+NET_PACKET = struct.Struct("<iiB")  # ack, first tick, inputs, followed by that many input bytes
+ROLLBACK_PACKET_INPUTS = 64  # most unacknowledged inputs sent in one packet
+ROLLBACK_MAX_PREDICTION = 30  # ticks we run ahead of the remote input, less than SNAPSHOT_HISTORY
+LOG_LEVEL = logging.WARNING  # logging.DEBUG to see camera and level messages
+LOG_RATE_LIMIT = 2  # records per second let through for each message
 
 SPRITE_SIZE = (20, 40)
 SPRITE_VELOCITY = (100, 0)  # This sprite moves at ~ 100 pixels per second
@@ -33,6 +93,308 @@ SPRITE_VELOCITY = (100, 0)  # This sprite moves at ~ 100 pixels per second
 PLAYER_ACCELERATION = SCREEN_SIZE[0] / 1000 # 0.6
 PLAYER_FRICTION = -0.12
 PLAYER_JUMP = -10 # how many pixels should the player jump
+PLAYER_GRAVITY = 0.5
+
+CAMERA_SCROLL_SPEED = 10
+
+PLATFORM_INDEX_CELL_SIZE = 128  # world pixels per spatial hash cell
+COLLISION_REGION_WIDTH = 4 * PLATFORM_INDEX_CELL_SIZE  # world pixels per column of collision boxes compiled together
+
+LEVEL_CHUNK_WIDTH = 2000  # world pixels per chunk when a level is split on disk
+LEVEL_LOAD_DISTANCE = SCREEN_SIZE[0]  # load chunks this close to the view
+LEVEL_UNLOAD_DISTANCE = 3 * SCREEN_SIZE[0]  # unload chunks this far from the view
+LEVEL_MEMORY_BUDGET = 64 * 1024 * 1024  # bytes of loaded platforms and their images before far chunks go
+PLATFORM_OVERHEAD_BYTES = 1024  # rough cost of a Platform besides its shared image
+LEVEL_EXTENSION = ".plvl"  # binary levels, anything else is a write_level directory
+LEVEL_MAGIC = b"PLVL"
+LEVEL_VERSION = 1
+# magic, version, reserved, width, height, chunk width, chunks, platforms, spawns
+LEVEL_HEADER = struct.Struct("<4sHHIIIIII")
+ASYNC_LOADING = True  # read level chunks and images on worker threads
+LOADER_THREADS = 2
+LOADER_FRAME_BUDGET = 0.002  # seconds per frame spent taking in loaded work
+LOADER_SLICE = 64  # platforms created per step of taking in a loaded chunk
+
+# platforms as (size, position, color), position being the top left in the world
+LEVEL = (
+    ((SCREEN_SIZE[0], 10), (SCREEN_SIZE[0], SCREEN_SIZE[1] - 10), (100, 100, 200)),
+    ((200, 10), (SCREEN_SIZE[0] - 200, 300), (100, 100, 200)),
+)
+
+
+def make_surface(size, color):
+    """
+    A surface filled with color. Only colors with an alpha below 255 get a
+    per-pixel alpha surface, so opaque sprites blit without alpha blending.
+    """
+    if len(color) == 4 and color[3] < 255:
+        surface = pg.Surface(size).convert_alpha()
+    else:
+        surface = pg.Surface(size).convert()
+    surface.fill(color)
+    return surface
+
+
+def surface_bytes(surface):
+    """
+    The pixel memory of surface.
+    """
+    return surface.get_pitch() * surface.get_height()
+
+
+class SurfaceCache(object):
+    """
+    Flyweight store of make_surface images, one per (size, color), for
+    sprites that never draw on their image. Memory then grows with the
+    number of different looks rather than the number of sprites. Every get
+    counts as a user of the image until a matching release, and an image is
+    dropped with its last user; bytes is the pixel memory of those kept.
+    """
+    def __init__(self):
+        self.surfaces = {}
+        self.users = {}
+        self.bytes = 0
+
+    def get(self, size, color):
+        key = (tuple(size), tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.surfaces[key] = make_surface(size, color)
+            self.users[key] = 0
+            self.bytes += surface_bytes(surface)
+        self.users[key] += 1
+        return surface
+
+    def release(self, size, color):
+        key = (tuple(size), tuple(color))
+        self.users[key] -= 1
+        if not self.users[key]:
+            del self.users[key]
+            surface = self.surfaces.pop(key)
+            self.bytes -= surface_bytes(surface)
+
+    def clear(self):
+        self.surfaces.clear()
+        self.users.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.surfaces)
+
+
+SURFACES = SurfaceCache()
+
+
+def swept_aabb(rect, dx, dy, other):
+    """
+    Sweep rect by (dx, dy) against the static rect other. Returns the time of
+    impact as a fraction of the move and the contact normal (nx, ny), or
+    (1.0, 0, 0) when they do not meet during the move. Rects that already
+    overlap at the start are left to the usual overlap test.
+    """
+    if dx > 0:
+        x_entry, x_exit = other.left - rect.right, other.right - rect.left
+    else:
+        x_entry, x_exit = other.right - rect.left, other.left - rect.right
+    if dy > 0:
+        y_entry, y_exit = other.top - rect.bottom, other.bottom - rect.top
+    else:
+        y_entry, y_exit = other.bottom - rect.top, other.top - rect.bottom
+
+    if dx == 0:
+        if rect.right <= other.left or rect.left >= other.right:
+            return 1.0, 0, 0
+        tx_entry, tx_exit = float('-inf'), float('inf')
+    else:
+        tx_entry, tx_exit = x_entry / dx, x_exit / dx
+    if dy == 0:
+        if rect.bottom <= other.top or rect.top >= other.bottom:
+            return 1.0, 0, 0
+        ty_entry, ty_exit = float('-inf'), float('inf')
+    else:
+        ty_entry, ty_exit = y_entry / dy, y_exit / dy
+
+    entry = max(tx_entry, ty_entry)
+    if entry > min(tx_exit, ty_exit) or entry < 0 or entry >= 1:
+        return 1.0, 0, 0
+    if tx_entry > ty_entry:
+        return entry, (-1 if dx > 0 else 1), 0
+    return entry, 0, (-1 if dy > 0 else 1)
+
+
+def merge_rect_runs(rects, horizontal):
+    """
+    Merge rects lying in the same row (same top and height) that touch or
+    overlap along x, or in the same column along y when not horizontal.
+    """
+    lines = {}
+    for rect in rects:
+        key = (rect.top, rect.height) if horizontal else (rect.left, rect.width)
+        lines.setdefault(key, []).append(rect)
+    merged = []
+    for line in lines.values():
+        line.sort(key=lambda rect: rect.left if horizontal else rect.top)
+        current = pg.Rect(line[0])
+        for rect in line[1:]:
+            if horizontal and rect.left <= current.right:
+                current.width = max(current.right, rect.right) - current.left
+            elif not horizontal and rect.top <= current.bottom:
+                current.height = max(current.bottom, rect.bottom) - current.top
+            else:
+                merged.append(current)
+                current = pg.Rect(rect)
+        merged.append(current)
+    return merged
+
+
+def compile_collision_rects(rects):
+    """
+    Merge adjacent platform rects into as few collision rects as we easily
+    can: first the runs along each row, then the stacks of identical runs.
+    The result is ordered top to bottom, left to right.
+    """
+    merged = merge_rect_runs(merge_rect_runs(rects, True), False)
+    merged.sort(key=lambda rect: (rect.top, rect.left))
+    return merged
+
+
+def blit_all(surface, items, areas=False):
+    """
+    Blit a sequence of (image, rect) in one call, using fblits where the
+    pygame build has it since it skips building the list of dirty rects.
+    When areas is set items may also be (image, rect, area), which only
+    blits takes.
+    """
+    fblits = getattr(surface, "fblits", None)
+    if fblits is not None and not areas:
+        fblits(items)
+    else:
+        surface.blits(items, False)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most rate records per second for each message, and
+    notes on the next one that gets through how many were dropped in between.
+    """
+    def __init__(self, rate=LOG_RATE_LIMIT):
+        super(RateLimitFilter, self).__init__()
+        self.interval = 1.0 / rate
+        self.last = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        key = record.msg
+        last = self.last.get(key)
+        if last is not None and record.created - last < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+        self.last[key] = record.created
+        record.suppressed = self.suppressed.pop(key, 0)
+        return True
+
+
+def configure_logging(level=LOG_LEVEL, rate=LOG_RATE_LIMIT):
+    """
+    Send engine logs to stderr as key=value lines. Records below level are
+    rejected by log.isEnabledFor before any formatting happens. The rate
+    limit sits on the handler so that records from child loggers, which
+    skip the parent's filters, are limited and numbered too.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s level=%(levelname)s logger=%(name)s %(message)s suppressed=%(suppressed)d"))
+    handler.addFilter(RateLimitFilter(rate))
+    log.addHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+
+
+class TextCache(object):
+    """
+    Rendered text surfaces keyed by string, dropping the least recently used
+    once it holds more than max_size of them.
+    """
+    def __init__(self, font, color, max_size=DEBUG_TEXT_CACHE_SIZE):
+        self.font = font
+        self.color = color
+        self.max_size = max_size
+        self.surfaces = OrderedDict()
+
+    def render(self, string):
+        surface = self.surfaces.get(string)
+        if surface is None:
+            surface = self.font.render(string, True, self.color)
+            self.surfaces[string] = surface
+            if len(self.surfaces) > self.max_size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(string)
+        return surface
+
+
+class FrameStats(object):
+    """
+    Rolling window of frame times kept in a ring buffer and a histogram,
+    both allocated up front, so recording a frame allocates nothing.
+    Percentiles are read from the histogram, to FRAME_STATS_BIN_MS.
+    """
+    def __init__(self, target_fps=FPS, size=FRAME_STATS_SIZE):
+        self.size = size
+        self.samples = array('d', [0.0]) * size
+        self.bins = array('l', [0]) * FRAME_STATS_BINS
+        self.dropped_threshold = DROPPED_FRAME_FACTOR / target_fps
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.dropped = 0
+
+    def bin(self, frame_time):
+        return min(int(frame_time * 1000.0 / FRAME_STATS_BIN_MS), FRAME_STATS_BINS - 1)
+
+    def record(self, frame_time):
+        """
+        Add a frame time in seconds, replacing the oldest once the window is full.
+        """
+        i = self.index
+        if self.count == self.size:
+            old = self.samples[i]
+            self.total -= old
+            self.bins[self.bin(old)] -= 1
+            if old > self.dropped_threshold:
+                self.dropped -= 1
+        else:
+            self.count += 1
+        self.samples[i] = frame_time
+        self.total += frame_time
+        self.bins[self.bin(frame_time)] += 1
+        if frame_time > self.dropped_threshold:
+            self.dropped += 1
+        self.index = (i + 1) % self.size
+
+    def percentile(self, fraction):
+        """
+        Upper edge of the histogram bin holding the given fraction of frames, in ms.
+        """
+        wanted = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.bins):
+            seen += n
+            if n and seen >= wanted:
+                return (i + 1) * FRAME_STATS_BIN_MS
+        return 0.0
+
+    def max(self):
+        if not self.count:
+            return 0.0
+        if self.count < self.size:
+            return max(self.samples[i] for i in range(self.count)) * 1000.0
+        return max(self.samples) * 1000.0
+
+    def fps(self):
+        if not self.total:
+            return 0.0
+        return self.count / self.total
 
 
 class DebugOverlay(pg.sprite.Sprite):
@@ -40,44 +402,61 @@ class DebugOverlay(pg.sprite.Sprite):
     This sprite provides a useful overlay of important information.
     Not really a sprite but we can add it to a SpriteGroup for updates.
     """
-    def __init__(self, position, size, color, player):
+    def __init__(self, position, size, color, player, frame_stats):
         super(DebugOverlay, self).__init__()
         self.size = size
         self.color = color
         self.player = player
-        self.image = pg.Surface(self.size).convert_alpha()
-        self.image.fill(self.color)
+        self.frame_stats = frame_stats
+        self.image = make_surface(self.size, self.color)
         self.rect = self.image.get_rect(center=position)
         self.font = pg.font.SysFont('Consolas', 12)
+        self.text_cache = TextCache(self.font, (255, 255, 255))
+        self.update_interval = 1.0 / DEBUG_OVERLAY_UPDATE_RATE
         self.position = position
         self.start_text_y = self.position[1] + 5
         self.start_time = time.time()
         self.time_now = self.start_time
+        self.last_update = None
         self.debug_text = []
+        self.dirty = True
 
     def update(self, keys, screen_rect, dt):
         """
-        Update the debug string with latest information.
+        Update the debug string with latest information, at most
+        DEBUG_OVERLAY_UPDATE_RATE times a second.
         """
         self.time_now = time.time()
-        self.debug_text = [
+        if self.last_update is not None and self.time_now - self.last_update < self.update_interval:
+            return
+        self.last_update = self.time_now
+        stats = self.frame_stats
+        debug_text = [
             "resolution: " + str(SCREEN_SIZE),
-            "FPS: " + str(FPS),
+            "FPS: %.1f (target %d)" % (stats.fps(), FPS),
+            "frame ms p50/p95/p99/max: %.2f/%.2f/%.2f/%.2f" % (
+                stats.percentile(0.5), stats.percentile(0.95),
+                stats.percentile(0.99), stats.max()),
+            "dropped frames: %d/%d" % (stats.dropped, stats.count),
             "dt: " + str(dt),
             "position" + str(self.player.position),
             "acceleration" + str(self.player.acceleration)
         ]
+        if debug_text != self.debug_text:
+            self.debug_text = debug_text
+            self.dirty = True
 
     def draw(self, surface):
         """
         Basic draw function.
         """
         start_y = self.start_text_y
-        surface.blit(self.image, self.rect)
+        dirty = surface.blit(self.image, self.rect)
         for string in self.debug_text:
-            rect = self.font.render(string, True, (255, 255, 255))
-            surface.blit(rect, (5, start_y))
+            rect = self.text_cache.render(string)
+            dirty.union_ip(surface.blit(rect, (5, start_y)))
             start_y += 15
+        return dirty
 
 
 class Player(pg.sprite.Sprite):
@@ -93,17 +472,46 @@ class Player(pg.sprite.Sprite):
         self.position = position
         self.velocity = vector(0,0)
         self.acceleration = vector(0,0)
-        self.image = pg.Surface(self.size).convert_alpha()
-        self.image.fill(self.color)
+        self.previous_position = vector(position)
+        self.scratch = vector(0, 0)
+        self.on_platform = False
+        self.store = None
+        self.index = None
+        self.image = make_surface(self.size, self.color)
+        self.page = self.area = None
+        if app.atlas is not None:
+            self.page, self.area = app.atlas.add(self.image)
+            self.image = self.page.subsurface(self.area)
         self.rect = self.image.get_rect(topright=position)
+        self.draw_rect = self.rect.copy()
+        self.world_rect = self.rect.copy()
+        self.sweep_rect = self.rect.copy()
+        self.sweep_area = self.rect.copy()
+        # reused every tick so that collision checks allocate nothing
+        self.touching = []
+        self.swept = []
+        self.landed = []
 
     def update(self, keys, screen_rect, camera, dt):
         """
-        Update accepts an argument dt (time delta between frames).
+        Update accepts an argument dt (the fixed physics tick).
         Adjustments to position must be multiplied by this delta.
         Set the rect to true_pos once adjusted (automatically converts to int).
+        When bound to an EntityStore this does nothing, the store steps every
+        actor at once instead.
         """
-        self.acceleration = vector(0, 0.5)
+        if self.store is not None:
+            return
+        self.control(keys)
+        self.integrate(dt)
+        self.resolve(screen_rect, camera)
+
+    def control(self, keys):
+        """
+        Work out this tick's acceleration from the keys held.
+        """
+        self.previous_position.update(self.position)
+        self.acceleration.update(0, PLAYER_GRAVITY)
         if keys[pg.K_RIGHT]:
             self.acceleration.x = PLAYER_ACCELERATION
         elif keys[pg.K_LEFT]:
@@ -114,16 +522,42 @@ class Player(pg.sprite.Sprite):
             self.velocity.x = 0
         if keys[pg.K_SPACE]:
             self.jump()        
-
         self.acceleration.x += self.velocity.x * PLAYER_FRICTION
-        self.velocity += self.acceleration
-        self.position += self.velocity + vector(0.5, 0.5) * vector(dt,dt) * self.acceleration    
+
+    def integrate(self, dt):
+        """
+        Move by this tick's velocity, in place so that no vectors are allocated.
+        """
+        # the constants are per reference frame, so scale them to this tick
+        step = dt * PHYSICS_REFERENCE_RATE
+        scratch = self.scratch
+        scratch.update(self.acceleration)
+        scratch *= step
+        self.velocity += scratch
+        scratch.update(self.velocity)
+        scratch *= step
+        self.position += scratch
+        scratch.update(self.acceleration)
+        scratch *= 0.5 * step * step
+        self.position += scratch
+
+    def resolve(self, screen_rect, camera, near=True):
+        """
+        Land on platforms and keep to the screen after moving. near=False
+        skips looking for platforms, for callers that know none are close.
+        """
         self.rect.midbottom = self.position  
 
-        # are we on a platform ?
-        result = pg.sprite.spritecollide(self, self.app.all_platforms, False)
+        result = None
+        if near:
+            # are we on a platform ?
+            result = self.collide_platforms(camera)
+        if near and not result:
+            # or did we move far enough this tick to pass straight through one?
+            result = self.sweep_platforms(camera)
+        self.on_platform = bool(result)
         if result:
-            self.fix_top(result[0].rect.top + 1)
+            self.fix_top(result[0].world_rect.top + 1)
 
         # have we reached the edge of the screen yet?
         if self.reached_edge():
@@ -133,6 +567,15 @@ class Player(pg.sprite.Sprite):
 
         # TODO: camera
 
+    def bind(self, store):
+        """
+        Keep this player's physics state in a row of store, which from now
+        on steps it. Our vectors are then copies of the row, refreshed
+        every tick by EntityStore.resolve.
+        """
+        self.store = store
+        self.index = store.add(self)
+
     def clamp(self, screen_rect):
         """
         Clamp the rect to the screen if needed and reset true_pos to the
@@ -140,19 +583,105 @@ class Player(pg.sprite.Sprite):
         """
         if not screen_rect.contains(self.rect):
             self.rect.clamp_ip(screen_rect)
-            self.position = vector(self.rect.midbottom)
+            self.position.update(self.rect.midbottom)
+
+    def interpolate(self, alpha):
+        """
+        Place the draw rect between the last two physics states.
+        """
+        self.draw_rect.midbottom = self.previous_position.lerp(self.position, alpha)
+
+    def save_state(self, buffer, offset):
+        """
+        Pack our physics state into buffer at offset, laid out as ACTOR_STATE.
+        """
+        position = self.position
+        velocity = self.velocity
+        acceleration = self.acceleration
+        previous = self.previous_position
+        ACTOR_STATE.pack_into(buffer, offset, position.x, position.y, velocity.x, velocity.y,
+                              acceleration.x, acceleration.y, previous.x, previous.y,
+                              self.rect.x, self.rect.y, self.direction, self.on_platform)
+
+    def load_state(self, buffer, offset):
+        (self.position.x, self.position.y, self.velocity.x, self.velocity.y,
+         self.acceleration.x, self.acceleration.y, self.previous_position.x,
+         self.previous_position.y, x, y, self.direction,
+         on_platform) = ACTOR_STATE.unpack_from(buffer, offset)
+        self.rect.topleft = (int(x), int(y))
+        self.on_platform = bool(on_platform)
+        if self.store is not None:
+            self.store.write(self.index, self)
+
+    def blit_item(self):
+        """
+        The (image, rect) to blit for this frame, or (page, rect, area)
+        when our image is in an atlas.
+        """
+        if self.page is not None:
+            return self.page, self.draw_rect, self.area
+        return self.image, self.draw_rect
 
     def draw(self, surface):
         """
         Basic draw function.
         """
-        surface.blit(self.image, self.rect)
+        return surface.blit(self.image, self.draw_rect)
 
     def jump(self):
-        result = pg.sprite.spritecollide(self, self.app.all_platforms, False)
-        if result:
+        if self.collide_platforms(self.app.camera):
             self.velocity.y = PLAYER_JUMP
 
+    def collide_platforms(self, camera):
+        """
+        The level's collision boxes we overlap, topmost first, in a list
+        reused by the next call. Only the boxes sharing a grid cell with us
+        are tested.
+        """
+        self.world_rect.update(self.rect)
+        self.world_rect.x += camera.offset()
+        boxes = self.app.collision_index().query(self.world_rect, self.touching)
+        if len(boxes) > 1:
+            boxes.sort(key=CollisionBox.top_left)
+        return boxes
+
+    def sweep_platforms(self, camera):
+        """
+        The first collision box we landed on while moving from previous_position to
+        position, found by sweeping our rect through the move, in which case we
+        are moved back to the point of contact. Only landing from above is
+        caught here; other contacts keep the overlap behaviour. The list
+        returned is reused by the next call.
+        """
+        start = self.sweep_rect
+        start.midbottom = self.previous_position
+        start.x += camera.offset()
+        dx = self.position.x - self.previous_position.x
+        dy = self.position.y - self.previous_position.y
+        landed = self.landed
+        landed.clear()
+        if dy <= 0:
+            return landed
+        # rects are whole pixels, so grow the area to cover the fractional move
+        area = self.sweep_area
+        area.update(self.world_rect)
+        area.union_ip(start)
+        area.inflate_ip(2, 2)
+        first = None
+        first_time = 1.0
+        for box in self.app.collision_index().query(area, self.swept):
+            toi, nx, ny = swept_aabb(start, dx, dy, box.world_rect)
+            if ny < 0 and toi < first_time:
+                first, first_time = box, toi
+        if first is None:
+            return landed
+        # back up to where we touched it
+        self.position.x = self.previous_position.x + dx * first_time
+        self.position.y = self.previous_position.y + dy * first_time
+        self.rect.midbottom = self.position
+        landed.append(first)
+        return landed
+
     def fix_top(self, top):
         self.position.y = top + 1
         self.velocity.y = 0
@@ -164,18 +693,213 @@ class Player(pg.sprite.Sprite):
         return self.rect.right >= SCREEN_SIZE[0]
 
 
+class EntityStore(object):
+    """
+    Positions, velocities and accelerations of many players held as rows
+    of contiguous NumPy arrays, which are their real physics state. One
+    vectorized control and integrate step moves all of them; only the
+    collision checks run per player, on state gathered from and scattered
+    back to the arrays in bulk. Removed rows are zeroed and reused.
+    """
+    def __init__(self, capacity=ENTITY_STORE_CAPACITY):
+        if np is None:
+            raise RuntimeError("EntityStore needs numpy")
+        self.count = 0
+        self.free = []
+        self.entities = []
+        self.right = 1 << INPUT_KEYS.index(pg.K_RIGHT)
+        self.left = 1 << INPUT_KEYS.index(pg.K_LEFT)
+        self.jump = 1 << INPUT_KEYS.index(pg.K_SPACE)
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        arrays = []
+        for old in ('positions', 'previous', 'velocities', 'accelerations', 'sizes'):
+            new = np.zeros((capacity, 2))
+            if self.count:
+                new[:self.count] = getattr(self, old)[:self.count]
+            arrays.append(new)
+        self.positions, self.previous, self.velocities, self.accelerations, self.sizes = arrays
+        self.inputs = np.zeros(capacity, np.uint8)
+        self.scratch = np.zeros((capacity, 2))
+        self.capacity = capacity
+
+    def add(self, entity):
+        """
+        Store a new entity, starting from its position, velocity and
+        acceleration, and return its row.
+        """
+        if self.free:
+            index = self.free.pop()
+            self.entities[index] = entity
+        else:
+            if self.count == self.capacity:
+                self.allocate(self.capacity * 2)
+            index = self.count
+            self.count += 1
+            self.entities.append(entity)
+        self.sizes[index] = entity.rect.size
+        self.write(index, entity)
+        return index
+
+    def write(self, index, entity):
+        """
+        Overwrite a row with the entity's vectors, after they were set from outside.
+        """
+        self.positions[index] = tuple(entity.position)
+        self.previous[index] = tuple(entity.previous_position)
+        self.velocities[index] = tuple(entity.velocity)
+        self.accelerations[index] = tuple(entity.acceleration)
+
+    def remove(self, index):
+        self.positions[index] = 0
+        self.previous[index] = 0
+        self.velocities[index] = 0
+        self.accelerations[index] = 0
+        self.entities[index] = None
+        self.free.append(index)
+
+    def control(self, keys, actor_keys, camera):
+        """
+        Player.control for every row at once. Every entity holds keys
+        unless actor_keys has others for it; only the ones holding jump
+        check for a platform to jump from.
+        """
+        n = self.count
+        inputs = self.inputs[:n]
+        inputs[:] = encode_keys(keys)
+        for entity, held in actor_keys.items():
+            if entity.store is self:
+                inputs[entity.index] = encode_keys(held)
+        if self.free:
+            inputs[self.free] = 0
+        np.copyto(self.previous[:n], self.positions[:n])
+        right = (inputs & self.right) != 0
+        left = (inputs & self.left) != 0
+        acceleration_x = self.accelerations[:n, 0]
+        velocity_x = self.velocities[:n, 0]
+        acceleration_x[:] = np.where(right, PLAYER_ACCELERATION, np.where(left, -PLAYER_ACCELERATION, 0.0))
+        self.accelerations[:n, 1] = PLAYER_GRAVITY
+        velocity_x[~(right | left)] = 0.0
+        for index in np.flatnonzero(inputs & self.jump):
+            if self.entities[index].collide_platforms(camera):
+                self.velocities[index, 1] = PLAYER_JUMP
+        scratch = self.scratch[:n, 0]
+        np.multiply(velocity_x, PLAYER_FRICTION, out=scratch)
+        acceleration_x += scratch
+        if self.free:
+            self.accelerations[self.free] = 0
+
+    def step(self, dt):
+        """
+        Integrate every entity over dt, the same way Player.integrate does.
+        """
+        step = dt * PHYSICS_REFERENCE_RATE
+        n = self.count
+        positions = self.positions[:n]
+        velocities = self.velocities[:n]
+        accelerations = self.accelerations[:n]
+        scratch = self.scratch[:n]
+        np.multiply(accelerations, step, out=scratch)
+        velocities += scratch
+        np.multiply(velocities, step, out=scratch)
+        positions += scratch
+        np.multiply(accelerations, 0.5 * step * step, out=scratch)
+        positions += scratch
+
+    def near_boxes(self, camera, collision_bounds):
+        """
+        Whether each row might touch a collision box this tick, tested for
+        all rows against all nearby boxes at once. The rects cover both
+        where the row was and where it is, grown by a margin for the
+        rounding to whole pixels, so a row found not near cannot collide.
+        """
+        n = self.count
+        margin = 4
+        offset = camera.offset()
+        positions = self.positions[:n]
+        previous = self.previous[:n]
+        half_width = self.sizes[:n, 0] / 2
+        left = np.minimum(positions[:, 0], previous[:, 0]) - half_width + (offset - margin)
+        right = np.maximum(positions[:, 0], previous[:, 0]) + half_width + (offset + margin)
+        top = np.minimum(positions[:, 1], previous[:, 1]) - self.sizes[:n, 1] - margin
+        bottom = np.maximum(positions[:, 1], previous[:, 1]) + margin
+        bounds = collision_bounds(left.min(), right.max())
+        if not len(bounds):
+            return [False] * n
+        near = ((left[:, None] < bounds[:, 2]) & (right[:, None] > bounds[:, 0]) &
+                (top[:, None] < bounds[:, 3]) & (bottom[:, None] > bounds[:, 1]))
+        return near.any(axis=1).tolist()
+
+    def resolve(self, screen_rect, camera, collision_bounds):
+        """
+        Run Player.resolve for every entity: gather the rows into its
+        vectors with one bulk read per array, and write back what the
+        collisions changed with one bulk write per array. Resolving only
+        ever zeroes the acceleration along x, so that is written back alone.
+        Rows near_boxes rules out skip the collision queries.
+        collision_bounds is App.collision_bounds.
+        """
+        n = self.count
+        if not n:
+            return
+        near = self.near_boxes(camera, collision_bounds)
+        positions = self.positions[:n].ravel().tolist()
+        previous = self.previous[:n].ravel().tolist()
+        velocities = self.velocities[:n].ravel().tolist()
+        accelerations = self.accelerations[:n].ravel().tolist()
+        for index, entity in enumerate(self.entities):
+            if entity is None:
+                continue
+            x = 2 * index
+            y = x + 1
+            position = entity.position
+            velocity = entity.velocity
+            acceleration = entity.acceleration
+            position.update(positions[x], positions[y])
+            entity.previous_position.update(previous[x], previous[y])
+            velocity.update(velocities[x], velocities[y])
+            acceleration.update(accelerations[x], accelerations[y])
+            entity.resolve(screen_rect, camera, near[index])
+            positions[x] = position.x
+            positions[y] = position.y
+            velocities[y] = velocity.y
+            if acceleration.x != accelerations[x]:
+                self.accelerations[index, 0] = acceleration.x
+        self.positions[:n].flat = positions
+        self.velocities[:n].flat = velocities
+
+
+class CollisionBox(object):
+    """
+    A solid part of the level, made from one or more merged platform rects.
+    It is kept apart from the Platform sprites that draw it.
+    """
+    def __init__(self, world_rect):
+        self.world_rect = world_rect
+
+    def top_left(self):
+        return self.world_rect.top, self.world_rect.left
+
+
 class Platform(pg.sprite.Sprite):
-    def __init__(self, camera, size, position, color):
+    def __init__(self, camera, size, position, color, atlas=None):
         super().__init__()
         self.camera = camera
         self.size = size
         self.start_pos = position
-        print(self.start_pos)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("platform created x=%s y=%s", position[0], position[1])
         self.color = color
-        self.image = pg.Surface(self.size).convert_alpha()
-        self.image.fill(self.color)
+        self.static = True
+        self.image = SURFACES.get(self.size, self.color)
+        self.page = self.area = None
+        if atlas is not None:
+            self.page, self.area = atlas.add(self.image)
+            self.image = self.page.subsurface(self.area)
         #self.rect = self.image.get_rect(center = (SCREEN_SIZE[0]/2, SCREEN_SIZE[1] - 10))
         self.rect = self.image.get_rect(topright=position)
+        self.world_rect = self.image.get_rect(topleft=position)
 
     def update(self, keys, screen_rect, camera, dt):
         #self.position -= vector(camera.target.position)
@@ -192,12 +916,27 @@ class Platform(pg.sprite.Sprite):
         #print(self.rect)
         None
 
+    def release(self):
+        """
+        Give our image back to SURFACES once we have left the level.
+        """
+        SURFACES.release(self.size, self.color)
+
+    def blit_item(self):
+        """
+        The (image, rect) to blit for this frame, placed for the camera, or
+        (page, rect, area) when our image is in an atlas.
+        """
+        self.rect.x = self.start_pos[0] - (SCREEN_SIZE[0] - self.camera.draw_position[0])
+        if self.page is not None:
+            return self.page, self.rect, self.area
+        return self.image, self.rect
+
     def draw(self, surface):
         """
         Basic draw function.
         """
-        self.rect.x = self.start_pos[0] - (SCREEN_SIZE[0] - self.camera.position[0])
-        surface.blit(self.image, self.rect)
+        return surface.blit(*self.blit_item())
         #surface.blit(self.image, (self.rect.x-self.camera.position[0], self.rect.y))
 
 
@@ -206,29 +945,70 @@ class Camera():
         self.virtual_screen_size = size
         # initially set to middle of screen
         self.position = vector(SCREEN_SIZE[0]/2, SCREEN_SIZE[1]/2)
+        self.previous_position = vector(self.position)
+        self.draw_position = vector(self.position)
         self.scroll = 0
         #print("initial")
         #print(self.position)
 
-    def update(self, target):
-        if target.acceleration.x == 0:
+    def offset(self):
+        """
+        Horizontal distance from world to screen coordinates.
+        """
+        return SCREEN_SIZE[0] - self.position[0]
+
+    def interpolate(self, alpha):
+        self.draw_position = self.previous_position.lerp(self.position, alpha)
+
+    def save_state(self, buffer, offset):
+        CAMERA_STATE.pack_into(buffer, offset, self.position.x, self.position.y,
+                               self.previous_position.x, self.previous_position.y, self.scroll)
+
+    def load_state(self, buffer, offset):
+        (self.position.x, self.position.y, self.previous_position.x,
+         self.previous_position.y, self.scroll) = CAMERA_STATE.unpack_from(buffer, offset)
+
+    def view_rect(self):
+        """
+        The part of the world on screen at the interpolated draw position.
+        """
+        return pg.Rect((SCREEN_SIZE[0] - self.draw_position[0], 0), SCREEN_SIZE)
+
+    def simulation_rect(self):
+        """
+        The part of the world on screen at the current physics position. The
+        simulation uses this rather than view_rect so it never depends on
+        whether, or when, a frame was drawn.
+        """
+        return pg.Rect((SCREEN_SIZE[0] - self.position[0], 0), SCREEN_SIZE)
+
+    def update(self, target, dt):
+        """
+        Scroll while the target walks into the outer quarter of the screen,
+        keeping the view between 0 and the level width.
+        """
+        self.previous_position.update(self.position)
+        if target.velocity.x == 0:
             self.scroll = 0
             #print("not moving")
             return
+        # the view's left edge is SCREEN_SIZE[0] - position[0]
+        lowest = 2 * SCREEN_SIZE[0] - max(self.virtual_screen_size[0], SCREEN_SIZE[0])
+        highest = SCREEN_SIZE[0]
         if target.velocity[0] < 0 and target.position[0] < int(SCREEN_SIZE[0] * 0.25):
-            print("scroll right")
-            if (self.position[0] > self.virtual_screen_size[0]-10):
-                self.position[0] += 10 # target.acceleration.x
-                self.moved = True
+            if self.position[0] < highest:
+                self.position[0] = min(self.position[0] + CAMERA_SCROLL_SPEED * dt * PHYSICS_REFERENCE_RATE,
+                                       highest)
             #self.scroll = target.acceleration.x
-            print(self.position)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("camera scroll direction=right x=%.1f y=%.1f", self.position[0], self.position[1])
         elif target.velocity [0] > 0 and target.position[0] > int(SCREEN_SIZE[0] * 0.75):
-            print("scroll left")
-            if (self.position[0] >= self.virtual_screen_size[0]-10):
-                self.position[0] -= 10 # target.acceleration.x
-                self.moved = True
+            if self.position[0] > lowest:
+                self.position[0] = max(self.position[0] - CAMERA_SCROLL_SPEED * dt * PHYSICS_REFERENCE_RATE,
+                                       lowest)
             #self.scroll = target.acceleration.x   
-            print(self.position) 
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("camera scroll direction=left x=%.1f y=%.1f", self.position[0], self.position[1])
             
         #print(target.position[0])
         #if self.position[0] != target.position[0]:
@@ -240,33 +1020,1262 @@ class Camera():
         #print(self.target.position)
 
 
+class SpriteAtlas(object):
+    """
+    Packs sprite images into a few large page surfaces, so that sprites
+    share their memory and are drawn as sub-rects of the same surfaces.
+    Pages are filled shelf by shelf: an image goes at the end of the
+    shortest shelf tall enough with room left, or opens a new shelf below
+    the last one. Opaque and translucent images go on separate pages so
+    opaque ones still blit without alpha blending. An image shared by
+    several sprites is only packed once.
+    """
+    def __init__(self, page_size=ATLAS_PAGE_SIZE):
+        self.page_size = page_size
+        self.pages = []  # [surface, alpha, shelves], a shelf being [top, height, next free x]
+        self.packed = {}
+
+    def add(self, image):
+        """
+        Copy image into the atlas and return the page holding it and its
+        area on the page.
+        """
+        if image in self.packed:
+            return self.packed[image]
+        width, height = image.get_size()
+        alpha = bool(image.get_flags() & pg.SRCALPHA)
+        for page in self.pages:
+            area = page[1] == alpha and self.place(page, width, height)
+            if area:
+                break
+        else:
+            page = self.new_page(alpha, width, height)
+            area = self.place(page, width, height)
+        surface = page[0]
+        if alpha:
+            # the page is transparent there, so adding copies the alpha as is
+            surface.blit(image, area, special_flags=pg.BLEND_RGBA_ADD)
+        else:
+            surface.blit(image, area)
+        self.packed[image] = surface, area
+        return surface, area
+
+    def new_page(self, alpha, width, height):
+        """
+        A page of page_size, or just big enough for an image that would not fit.
+        """
+        size = self.page_size
+        if width > size[0] or height > size[1]:
+            size = (width, height)
+        if alpha:
+            surface = pg.Surface(size, pg.SRCALPHA).convert_alpha()
+        else:
+            surface = pg.Surface(size).convert()
+        page = [surface, alpha, []]
+        self.pages.append(page)
+        return page
+
+    def place(self, page, width, height):
+        surface, _, shelves = page
+        page_width, page_height = surface.get_size()
+        best = None
+        for shelf in shelves:
+            if height <= shelf[1] and shelf[2] + width <= page_width:
+                if best is None or shelf[1] < best[1]:
+                    best = shelf
+        if best is None:
+            top = shelves[-1][0] + shelves[-1][1] if shelves else 0
+            if top + height > page_height or width > page_width:
+                return None
+            best = [top, height, 0]
+            shelves.append(best)
+        area = pg.Rect(best[2], best[0], width, height)
+        best[2] += width
+        return area
+
+
+class SpatialHash(object):
+    """
+    Uniform grid broadphase. Sprites register with a world rect and a query
+    only looks at the grid cells the query rect touches, so its cost depends
+    on how crowded that part of the level is rather than on the level size.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.rects = {}
+        self.order = {}
+        self.count = 0
+        self.found = set()
+
+    def cell_range(self, rect):
+        size = self.cell_size
+        x1 = (rect.left + max(rect.width, 1) - 1) // size
+        y1 = (rect.top + max(rect.height, 1) - 1) // size
+        for x in range(rect.left // size, x1 + 1):
+            for y in range(rect.top // size, y1 + 1):
+                yield (x, y)
+
+    def insert(self, sprite, rect):
+        if sprite in self.rects:
+            self.remove(sprite)
+        rect = pg.Rect(rect)
+        self.rects[sprite] = rect
+        self.order[sprite] = self.count
+        self.count += 1
+        for cell in self.cell_range(rect):
+            self.cells.setdefault(cell, []).append(sprite)
+
+    def remove(self, sprite):
+        rect = self.rects.pop(sprite)
+        del self.order[sprite]
+        for cell in self.cell_range(rect):
+            bucket = self.cells[cell]
+            bucket.remove(sprite)
+            if not bucket:
+                del self.cells[cell]
+
+    def query(self, rect, result=None):
+        """
+        Sprites whose rect overlaps rect, in the order they were inserted.
+        They are put in result, emptied first, when given so that a caller
+        querying every tick can reuse one list.
+        """
+        if result is None:
+            result = []
+        else:
+            result.clear()
+        rects = self.rects
+        cells = self.cells
+        found = self.found
+        size = self.cell_size
+        x1 = (rect.left + max(rect.width, 1) - 1) // size
+        y1 = (rect.top + max(rect.height, 1) - 1) // size
+        for x in range(rect.left // size, x1 + 1):
+            for y in range(rect.top // size, y1 + 1):
+                bucket = cells.get((x, y))
+                if bucket is None:
+                    continue
+                for sprite in bucket:
+                    if sprite not in found and rect.colliderect(rects[sprite]):
+                        found.add(sprite)
+                        result.append(sprite)
+        found.clear()
+        if len(result) > 1:
+            result.sort(key=self.order.__getitem__)
+        return result
+
+    def __len__(self):
+        return len(self.rects)
+
+
+class ScriptedKeys(object):
+    """
+    Stands in for pg.key.get_pressed() when input comes from a script
+    rather than the keyboard.
+    """
+    def __init__(self, pressed=()):
+        self.pressed = frozenset(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
+NO_KEYS = ScriptedKeys()
+# the keys held for every mask encode_keys can return
+DECODED_KEYS = tuple(ScriptedKeys(key for bit, key in enumerate(INPUT_KEYS) if mask >> bit & 1)
+                     for mask in range(1 << len(INPUT_KEYS)))
+
+
+def encode_keys(keys):
+    """
+    The keys of INPUT_KEYS held in keys as a bitmask, see DECODED_KEYS.
+    """
+    mask = 0
+    for bit, key in enumerate(INPUT_KEYS):
+        if keys[key]:
+            mask |= 1 << bit
+    return mask
+
+
+def level_digest(level_path):
+    """
+    A short hash of the files of the level at level_path, or of nothing
+    for the built-in level, that tells apart the levels a replay was
+    recorded on.
+    """
+    digest = hashlib.blake2b(digest_size=REPLAY_DIGEST_SIZE)
+    if level_path is not None:
+        if os.path.isdir(level_path):
+            paths = [os.path.join(level_path, name) for name in sorted(os.listdir(level_path))]
+        else:
+            paths = [level_path]
+        for path in paths:
+            digest.update(os.path.basename(path).encode())
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.digest()
+
+
+class InputRecorder(object):
+    """
+    Records the keys held on every physics tick as one byte, a bit per key
+    of INPUT_KEYS, so a session can be replayed tick for tick. The replay
+    notes the level it was played on, see level_digest.
+    """
+    def __init__(self, tick_rate, level_path=None):
+        self.tick_rate = tick_rate
+        self.level = level_digest(level_path)
+        self.ticks = array('B')
+
+    def record(self, keys):
+        self.ticks.append(encode_keys(keys))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.tick_rate,
+                                       len(self.ticks), self.level))
+            f.write(self.ticks.tobytes())
+
+
+def load_replay(path, level_path=None, check_level=True):
+    """
+    The tick rate and the keys held on every tick of a replay saved by
+    InputRecorder, ready for App.run_headless. Raises ValueError if the
+    replay was recorded on another level than level_path, unless
+    check_level is false.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, tick_rate, count, level = REPLAY_HEADER.unpack_from(data)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError("%s is not a version %d replay" % (path, REPLAY_VERSION))
+    if check_level and level != level_digest(level_path):
+        raise ValueError("%s was recorded on another level than %s"
+                         % (path, level_path or "the built-in one"))
+    masks = data[REPLAY_HEADER.size:REPLAY_HEADER.size + count]
+    return tick_rate, [DECODED_KEYS[mask] for mask in masks]
+
+
+class LoopbackPeer(object):
+    """
+    One end of a UDP link on localhost that holds back what it sends by
+    latency seconds and drops a loss fraction of it, to try the netcode
+    under bad conditions without a network. clock can be replaced to run
+    on simulated time.
+    """
+    def __init__(self, port=0, latency=NET_LATENCY, loss=NET_LOSS, seed=None, clock=time.perf_counter):
+        if not 0 <= loss < 1:
+            raise ValueError("loss has to be at least 0 and below 1, not %r" % loss)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", port))
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+        self.remote = None
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.outbox = deque()
+        self.sent = 0
+        self.dropped = 0
+
+    def connect(self, address):
+        self.remote = address
+
+    def send(self, packet):
+        self.sent += 1
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        self.outbox.append((self.clock() + self.latency, packet))
+
+    def poll(self):
+        """
+        Put on the wire whatever has been held back long enough and return
+        the packets that have arrived.
+        """
+        now = self.clock()
+        outbox = self.outbox
+        while outbox and outbox[0][0] <= now:
+            self.socket.sendto(outbox.popleft()[1], self.remote)
+        received = []
+        while True:
+            try:
+                received.append(self.socket.recv(NET_MAX_PACKET))
+            except (BlockingIOError, ConnectionError):
+                return received
+
+    def close(self):
+        self.socket.close()
+
+
+class RollbackSession(object):
+    """
+    Two player rollback netcode. Both clients simulate both players, with
+    the camera on player 0 so that their worlds agree. The remote player's
+    input for a tick is predicted to be the last one received; when the real
+    one turns out different the world is restored from the snapshot before
+    that tick and simulated forward again. Inputs are sent again in every
+    packet until acknowledged, so a lost packet only costs latency.
+    """
+    def __init__(self, app, peer, local, color=(0, 0, 255)):
+        if app.snapshots is None:
+            raise RuntimeError("rollback needs SNAPSHOT_HISTORY")
+        if app.tick_count:
+            raise ValueError("a rollback session has to start from the first tick")
+        self.app = app
+        self.peer = peer
+        self.local = local
+        spawn = app.player.position + vector(2 * SPRITE_SIZE[0], 0)
+        second = Player(app, spawn, SPRITE_SIZE, color, SPRITE_VELOCITY)
+        app.add_actor(second)
+        self.players = (app.player, second)
+        self.local_inputs = array('B')
+        self.remote_inputs = array('B')  # every remote input up to the first one missing
+        self.early_inputs = {}  # remote inputs received past a missing one
+        self.predicted = array('B')  # the remote input each tick was simulated with
+        self.acked = 0  # local inputs the remote has received
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.stalls = 0
+        app.snapshots.save()
+
+    def advance(self, keys):
+        """
+        Simulate the next tick with keys held by the local player. Returns
+        False, simulating nothing, when we are too far ahead of the remote.
+        """
+        self.receive()
+        tick = self.app.tick_count
+        if tick - len(self.remote_inputs) >= ROLLBACK_MAX_PREDICTION:
+            self.stalls += 1
+            self.send()
+            return False
+        self.local_inputs.append(encode_keys(keys))
+        self.simulate(tick)
+        self.send()
+        return True
+
+    def idle(self):
+        """
+        Keep exchanging inputs, and correcting the world, without advancing.
+        """
+        self.receive()
+        self.send()
+
+    def receive(self):
+        known = len(self.remote_inputs)
+        for packet in self.peer.poll():
+            if len(packet) < NET_PACKET.size:
+                continue
+            ack, first, count = NET_PACKET.unpack_from(packet)
+            count = min(count, len(packet) - NET_PACKET.size)
+            self.acked = max(self.acked, ack)
+            for tick, mask in enumerate(packet[NET_PACKET.size:NET_PACKET.size + count], first):
+                if tick >= len(self.remote_inputs):
+                    self.early_inputs[tick] = mask
+            while len(self.remote_inputs) in self.early_inputs:
+                self.remote_inputs.append(self.early_inputs.pop(len(self.remote_inputs)))
+        for tick in range(known, min(len(self.remote_inputs), len(self.predicted))):
+            if self.predicted[tick] != self.remote_inputs[tick]:
+                self.rollback(tick)
+                break
+
+    def send(self):
+        first = self.acked
+        inputs = self.local_inputs[first:first + ROLLBACK_PACKET_INPUTS]
+        header = NET_PACKET.pack(len(self.remote_inputs), first, len(inputs))
+        self.peer.send(header + inputs.tobytes())
+
+    def rollback(self, tick):
+        """
+        Go back to before tick and simulate up to the present again.
+        """
+        app = self.app
+        start = app.profiler.begin()
+        now = app.tick_count
+        app.snapshots.restore(tick)
+        app.resimulating = True
+        try:
+            for past in range(tick, now):
+                self.simulate(past)
+        finally:
+            app.resimulating = False
+        self.rollbacks += 1
+        self.resimulated += now - tick
+        app.profiler.end("RollbackSession.rollback", start)
+
+    def simulate(self, tick):
+        if tick < len(self.remote_inputs):
+            remote = self.remote_inputs[tick]
+        else:
+            remote = self.remote_inputs[-1] if self.remote_inputs else 0
+        if tick < len(self.predicted):
+            self.predicted[tick] = remote
+        else:
+            self.predicted.append(remote)
+        app = self.app
+        app.keys = DECODED_KEYS[self.local_inputs[tick]]
+        app.actor_keys[self.players[1 - self.local]] = DECODED_KEYS[remote]
+        app.update(1.0 / app.tick_rate)
+
+
+def run_loopback_match(ticks, latency=NET_LATENCY, loss=NET_LOSS, seed=0, level=LEVEL):
+    """
+    Play two rollback clients against each other headless over a lossy
+    loopback link on simulated time, both pressing random keys for ticks
+    ticks, until each has the other's every input. Returns both sessions,
+    whose worlds should then be bit-identical.
+    """
+    now = [0.0]
+    clock = lambda: now[0]
+    peers = [LoopbackPeer(latency=latency, loss=loss, seed=seed + i, clock=clock) for i in range(2)]
+    peers[0].connect(peers[1].address)
+    peers[1].connect(peers[0].address)
+    sessions = [RollbackSession(App(level=level), peer, i) for i, peer in enumerate(peers)]
+    players = [random.Random(seed + 2 + i) for i in range(2)]
+    keys = [NO_KEYS, NO_KEYS]
+    while any(session.app.tick_count < ticks or len(session.remote_inputs) < ticks
+              for session in sessions):
+        now[0] += 1.0 / PHYSICS_TICK_RATE
+        for i, session in enumerate(sessions):
+            if session.app.tick_count < ticks:
+                if players[i].random() < 0.05:
+                    keys[i] = DECODED_KEYS[players[i].randrange(len(DECODED_KEYS))]
+                session.advance(keys[i])
+            else:
+                session.idle()
+    for peer in peers:
+        peer.close()
+    return sessions
+
+
+class SnapshotRing(object):
+    """
+    The world state of the last capacity ticks, each packed by App.save_state
+    into its own preallocated buffer, so saving or restoring a tick copies a
+    few hundred bytes instead of deep copying sprites and surfaces. The
+    buffers are reallocated, dropping what they held, if the number of
+    actors changes.
+    """
+    def __init__(self, app, capacity=SNAPSHOT_HISTORY):
+        self.app = app
+        self.capacity = capacity
+        self.allocate()
+
+    def allocate(self):
+        self.size = self.app.state_size()
+        self.buffers = [bytearray(self.size) for _ in range(self.capacity)]
+        self.ticks = array('q', [-1] * self.capacity)
+
+    def save(self):
+        """
+        Keep the state of the app's current tick, over the oldest one kept.
+        """
+        if self.app.state_size() != self.size:
+            self.allocate()
+        tick = self.app.tick_count
+        slot = tick % self.capacity
+        self.app.save_state(self.buffers[slot])
+        self.ticks[slot] = tick
+
+    def __contains__(self, tick):
+        return tick >= 0 and self.ticks[tick % self.capacity] == tick
+
+    def restore(self, tick):
+        """
+        Put the world back the way it was at the end of tick.
+        """
+        if tick not in self:
+            raise KeyError("tick %d is not in the snapshot history" % tick)
+        self.app.load_state(self.buffers[tick % self.capacity])
+
+
+class FrameProfiler(object):
+    """
+    Records how long each phase of the loop takes into a fixed size ring
+    buffer, which can be exported as a Chrome trace (chrome://tracing or
+    https://ui.perfetto.dev). Entity updates are named after the entity's
+    class. When disabled begin/end return straight away, and a span begun
+    while disabled is not recorded even if recording starts before it ends.
+    """
+    def __init__(self, size=PROFILE_BUFFER_SIZE, enabled=PROFILE):
+        self.size = size
+        self.enabled = enabled
+        self.names = [None] * size
+        self.starts = array('q', [0]) * size
+        self.durations = array('q', [0]) * size
+        self.index = 0
+        self.count = 0
+
+    def begin(self):
+        if not self.enabled:
+            return 0
+        return time.perf_counter_ns()
+
+    def end(self, name, start):
+        if not self.enabled or not start:
+            return
+        i = self.index
+        self.names[i] = name
+        self.starts[i] = start
+        self.durations[i] = time.perf_counter_ns() - start
+        self.index = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    def samples(self):
+        """
+        (name, start_ns, duration_ns) for every sample held, oldest first.
+        """
+        first = (self.index - self.count) % self.size
+        for n in range(self.count):
+            i = (first + n) % self.size
+            yield self.names[i], self.starts[i], self.durations[i]
+
+    def export_chrome_trace(self, path=PROFILE_TRACE_PATH):
+        pid = os.getpid()
+        events = [
+            {"name": name, "ph": "X", "ts": start / 1000.0, "dur": duration / 1000.0,
+             "pid": pid, "tid": 0}
+            for name, start, duration in self.samples()
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+
+class StaticLayer(object):
+    """
+    The background and every static platform baked into square chunk
+    surfaces of the world, so drawing the level takes one blit per chunk on
+    screen. Chunks are baked when first drawn and kept in an LRU cache.
+    """
+    def __init__(self, index, background_color, chunk_size=STATIC_CHUNK_SIZE,
+                 max_chunks=STATIC_CHUNK_CACHE_SIZE):
+        self.index = index
+        self.background_color = background_color
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.chunks = OrderedDict()
+
+    def chunk_rect(self, cx, cy):
+        size = self.chunk_size
+        return pg.Rect(cx * size, cy * size, size, size)
+
+    def chunk(self, cx, cy):
+        surface = self.chunks.get((cx, cy))
+        if surface is not None:
+            self.chunks.move_to_end((cx, cy))
+            return surface
+        rect = self.chunk_rect(cx, cy)
+        surface = pg.Surface(rect.size).convert()
+        surface.fill(self.background_color)
+        for platform in self.index.query(rect):
+            if platform.static:
+                surface.blit(platform.image, platform.world_rect.move(-rect.x, -rect.y))
+        self.chunks[(cx, cy)] = surface
+        if len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+        return surface
+
+    def invalidate(self, rect=None):
+        """
+        Drop the baked chunks overlapping the world rect, or all of them.
+        """
+        if rect is None:
+            self.chunks.clear()
+            return
+        for cx, cy in list(self.chunks):
+            if self.chunk_rect(cx, cy).colliderect(rect):
+                del self.chunks[(cx, cy)]
+
+    def draw(self, surface, view_rect, area=None):
+        """
+        Draw the part of the world in view_rect, or only the screen rect area of it.
+        """
+        left, top = view_rect.topleft
+        target = view_rect if area is None else view_rect.clip(pg.Rect(area).move(left, top))
+        if not target.width or not target.height:
+            return
+        size = self.chunk_size
+        for cx in range(target.left // size, (target.right - 1) // size + 1):
+            for cy in range(target.top // size, (target.bottom - 1) // size + 1):
+                rect = self.chunk_rect(cx, cy)
+                clip = rect.clip(target)
+                surface.blit(self.chunk(cx, cy), (clip.x - left, clip.y - top),
+                             clip.move(-rect.x, -rect.y))
+
+
+def split_level(level, chunk_width):
+    """
+    Group the platforms of level into chunk_width wide chunks, returned as
+    {chunk index: [(size, position, color), ...]}. Platforms crossing a chunk
+    edge are cut in two; the merged collision geometry joins them up again.
+    """
+    chunks = {}
+    for (width, height), (left, top), color in level:
+        right = left + width
+        for index in range(int(left // chunk_width), int((right - 1) // chunk_width) + 1):
+            piece_left = max(left, index * chunk_width)
+            piece_right = min(right, (index + 1) * chunk_width)
+            chunks.setdefault(index, []).append(
+                ((piece_right - piece_left, height), (piece_left, top), tuple(color)))
+    return chunks
+
+
+def write_level(path, level, chunk_width=LEVEL_CHUNK_WIDTH, size=VIRTUAL_SCREEN_SIZE, spawns=()):
+    """
+    Write level as a directory of JSON chunks that ChunkStreamer can stream.
+    """
+    chunks = split_level(level, chunk_width)
+    os.makedirs(path, exist_ok=True)
+    count = max(chunks) + 1 if chunks else 0
+    for index in range(count):
+        with open(os.path.join(path, "chunk_%05d.json" % index), "w") as f:
+            json.dump(chunks.get(index, []), f)
+    with open(os.path.join(path, "level.json"), "w") as f:
+        json.dump({"size": list(size), "chunk_width": chunk_width, "chunks": count,
+                   "spawns": [list(spawn) for spawn in spawns]}, f)
+
+
+def write_binary_level(path, level, chunk_width=LEVEL_CHUNK_WIDTH, size=VIRTUAL_SCREEN_SIZE,
+                       spawns=(), tiles=None):
+    """
+    Write level in the compact binary format read by BinaryLevel: a header,
+    a table of (first platform, platform count) per chunk, then one column
+    each of platform x, y, width, height, RGBA color and tile id, and finally
+    the spawn points. Everything is little endian and 4 byte aligned.
+    tiles gives a tile id per platform of level, 0 meaning none.
+    """
+    if tiles is not None:
+        level = [(size_, position, (color, tile))
+                 for (size_, position, color), tile in zip(level, tiles)]
+    else:
+        level = [(size_, position, (color, 0)) for size_, position, color in level]
+    chunks = split_level(level, chunk_width)
+    count = max(chunks) + 1 if chunks else 0
+    table = array('I')
+    columns = [array('i') for _ in range(4)]
+    colors = bytearray()
+    tile_ids = array('I')
+    for index in range(count):
+        chunk = chunks.get(index, [])
+        table.extend((len(tile_ids), len(chunk)))
+        for (width, height), (x, y), (color, tile) in chunk:
+            for column, value in zip(columns, (x, y, width, height)):
+                column.append(int(value))
+            colors.extend(tuple(color) + (255,) * (4 - len(color)))
+            tile_ids.append(tile)
+    spawn_points = array('i', [int(value) for spawn in spawns for value in spawn])
+    blocks = [table] + columns + [tile_ids, spawn_points]
+    if sys.byteorder != 'little':
+        for block in blocks:
+            block.byteswap()
+    with open(path, "wb") as f:
+        f.write(LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, 0, size[0], size[1], chunk_width,
+                                  count, len(tile_ids), len(spawns)))
+        for block in blocks[:5]:
+            f.write(block.tobytes())
+        f.write(colors)
+        for block in blocks[5:]:
+            f.write(block.tobytes())
+
+
+def convert_level(source, dest):
+    """
+    Convert a JSON level to the binary format. The source looks like
+    {"size": [w, h], "chunk_width": 2000, "spawns": [[x, y]],
+     "platforms": [{"size": [w, h], "position": [x, y], "color": [r, g, b], "tile": 0}]}
+    where chunk_width, spawns and tile are optional.
+    """
+    with open(source) as f:
+        data = json.load(f)
+    platforms = data["platforms"]
+    level = [(p["size"], p["position"], p["color"]) for p in platforms]
+    write_binary_level(dest, level, data.get("chunk_width", LEVEL_CHUNK_WIDTH),
+                       data["size"], data.get("spawns", ()),
+                       [p.get("tile", 0) for p in platforms])
+
+
+class LevelDirectory(object):
+    """
+    A level written by write_level, read one JSON chunk at a time.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "level.json")) as f:
+            meta = json.load(f)
+        self.size = tuple(meta["size"])
+        self.chunk_width = meta["chunk_width"]
+        self.chunk_count = meta["chunks"]
+        self.spawns = [tuple(spawn) for spawn in meta.get("spawns", ())]
+
+    def read_chunk(self, index):
+        with open(os.path.join(self.path, "chunk_%05d.json" % index)) as f:
+            return json.load(f)
+
+
+class BinaryLevel(object):
+    """
+    A level written by write_binary_level, memory mapped so that opening it
+    only parses the header. The columns are memoryviews straight into the
+    mapping, and read_chunk only touches the rows of that chunk.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, width, height, self.chunk_width, self.chunk_count,
+         self.platform_count, spawn_count) = LEVEL_HEADER.unpack_from(self.map)
+        if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+            self.map.close()
+            raise ValueError("%s is not a version %d level" % (path, LEVEL_VERSION))
+        self.size = (width, height)
+        self.offset = LEVEL_HEADER.size
+        self.table = self.column('I', 2 * self.chunk_count)
+        self.xs = self.column('i', self.platform_count)
+        self.ys = self.column('i', self.platform_count)
+        self.widths = self.column('i', self.platform_count)
+        self.heights = self.column('i', self.platform_count)
+        self.colors = self.column('B', 4 * self.platform_count)
+        self.tiles = self.column('I', self.platform_count)
+        points = self.column('i', 2 * spawn_count)
+        self.spawns = [(points[2 * i], points[2 * i + 1]) for i in range(spawn_count)]
+
+    def column(self, typecode, count):
+        """
+        The next count values of the file. Zero copy unless this machine is
+        big endian, in which case they are copied and swapped.
+        """
+        size = struct.calcsize(typecode) * count
+        view = memoryview(self.map)[self.offset:self.offset + size].cast(typecode)
+        self.offset += size
+        if sys.byteorder != 'little' and typecode != 'B':
+            copy = array(typecode, view)
+            view.release()
+            copy.byteswap()
+            return copy
+        return view
+
+    def platform(self, i):
+        color = tuple(self.colors[4 * i:4 * i + 4])
+        if color[3] == 255:
+            color = color[:3]
+        return ((self.widths[i], self.heights[i]), (self.xs[i], self.ys[i]), color)
+
+    def read_chunk(self, index):
+        first = self.table[2 * index]
+        return [self.platform(i) for i in range(first, first + self.table[2 * index + 1])]
+
+    def platforms(self):
+        """
+        Every platform, for building the whole level at once with App(level=...).
+        """
+        return [self.platform(i) for i in range(self.platform_count)]
+
+    def close(self):
+        for name in ('table', 'xs', 'ys', 'widths', 'heights', 'colors', 'tiles'):
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                column.release()
+        self.map.close()
+
+
+def open_level(path):
+    """
+    A level on disk: a binary level file or a write_level directory.
+    """
+    if path.endswith(LEVEL_EXTENSION):
+        return BinaryLevel(path)
+    return LevelDirectory(path)
+
+
+class AsyncLoader(object):
+    """
+    Runs loading jobs (reading files, parsing level data, decoding images)
+    on worker threads. Finished results wait in a queue until drain() hands
+    them to their callbacks on the main thread, stopping once the frame's
+    budget is spent so that loading never stalls a frame for long. A
+    callback with a lot to do on the main thread returns a generator, which
+    drain() steps through over as many frames as it takes.
+    """
+    def __init__(self, threads=LOADER_THREADS, budget=LOADER_FRAME_BUDGET):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="loader")
+        self.finished = queue.Queue()
+        self.working = deque()
+        self.budget = budget
+
+    def submit(self, callback, job, *args, error=None):
+        """
+        Run job(*args) on a worker and later call callback with its result,
+        or error with the exception if it fails.
+        """
+        future = self.executor.submit(job, *args)
+        future.add_done_callback(lambda future: self.finished.put((callback, error, future)))
+        return future
+
+    def load_image(self, path, callback):
+        """
+        Decode the image at path on a worker. pygame releases the GIL while it
+        decodes; converting to the display format is left to the callback,
+        which runs on the main thread.
+        """
+        return self.submit(callback, pg.image.load, path)
+
+    def drain(self):
+        """
+        Step the callbacks' unfinished work, then hand finished results to
+        their callbacks, until the budget is spent. At least one step is
+        taken per call so loading always advances.
+        """
+        deadline = time.perf_counter() + self.budget
+        while True:
+            if self.working:
+                try:
+                    next(self.working[0])
+                except StopIteration:
+                    self.working.popleft()
+                except Exception:
+                    self.working.popleft()
+                    log.exception("background load failed")
+            else:
+                try:
+                    callback, error, future = self.finished.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    log.exception("background load failed")
+                    if error is not None:
+                        error(exc)
+                else:
+                    work = callback(result)
+                    if work is not None:
+                        self.working.append(work)
+            if time.perf_counter() >= deadline:
+                return
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class ChunkStreamer(object):
+    """
+    Loads the chunks of a level from open_level as the camera gets
+    near them and unloads them again once they are far away, or sooner when
+    the loaded platforms go over the memory budget. With a loader, chunks are
+    read on its worker threads and their platforms created a slice at a time
+    within the loader's budget; only a chunk the camera is already looking
+    at is ever read or created in one go.
+    """
+    def __init__(self, app, level, load_distance=LEVEL_LOAD_DISTANCE,
+                 unload_distance=LEVEL_UNLOAD_DISTANCE, budget=LEVEL_MEMORY_BUDGET,
+                 loader=None):
+        self.app = app
+        self.level = level
+        self.loader = loader
+        self.pending = set()
+        self.building = {}  # index -> (work, platforms so far) of chunks being created
+        self.load_distance = load_distance
+        self.unload_distance = unload_distance
+        self.budget = budget
+        self.size = level.size
+        self.chunk_width = level.chunk_width
+        self.chunk_count = level.chunk_count
+        self.loaded = {}
+        self.images = {}  # (size, color) -> loaded platforms showing that image
+        self.used = 0
+
+    def chunk_range(self, left, right):
+        first = max(int(left // self.chunk_width), 0)
+        last = min(int(right // self.chunk_width), self.chunk_count - 1)
+        return range(first, last + 1)
+
+    def read_chunk(self, index):
+        return self.level.read_chunk(index)
+
+    def load(self, index, data):
+        """
+        Create the platforms of a chunk from its data and add them to the level.
+        """
+        for _ in self.start_building(index, data):
+            pass
+
+    def start_building(self, index, data):
+        """
+        The work of creating a chunk, a generator that creates LOADER_SLICE
+        platforms each time it is stepped.
+        """
+        platforms = []
+        work = self.build(index, data, platforms)
+        self.building[index] = work, platforms
+        return work
+
+    def build(self, index, data, platforms):
+        camera = self.app.camera
+        cost = 0
+        for count, (size, position, color) in enumerate(data, 1):
+            platform = Platform(camera, size, position, color)
+            self.app.add_platform(platform)
+            platforms.append(platform)
+            added = PLATFORM_OVERHEAD_BYTES + self.hold_image(platform)
+            cost += added
+            self.used += added
+            if count % LOADER_SLICE == 0:
+                yield
+        del self.building[index]
+        self.loaded[index] = platforms
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("chunk loaded index=%d platforms=%d bytes=%d", index, len(platforms), cost)
+
+    def finish_building(self, index):
+        for _ in self.building[index][0]:
+            pass
+
+    def abandon(self, index):
+        """
+        Stop creating a chunk and take out the platforms made so far.
+        """
+        work, platforms = self.building.pop(index)
+        work.close()
+        self.remove(platforms)
+
+    def loaded_in_background(self, index, data):
+        """
+        Loader callback: start creating a chunk that was read on a worker.
+        """
+        self.pending.discard(index)
+        if index in self.loaded or index in self.building:
+            return None
+        return self.start_building(index, data)
+
+    def failed_in_background(self, index, error):
+        self.pending.discard(index)
+
+    def hold_image(self, platform):
+        """
+        Count platform as showing its image. Returns the bytes of the image
+        when no other loaded platform shows it, which the chunk pays for;
+        the charge does not depend on what else SURFACES happens to hold.
+        """
+        key = (tuple(platform.size), tuple(platform.color))
+        users = self.images.get(key, 0)
+        self.images[key] = users + 1
+        return 0 if users else surface_bytes(platform.image)
+
+    def drop_image(self, platform):
+        """
+        Undo hold_image, returning the bytes no longer paid for.
+        """
+        key = (tuple(platform.size), tuple(platform.color))
+        users = self.images[key] - 1
+        if users:
+            self.images[key] = users
+            return 0
+        del self.images[key]
+        return surface_bytes(platform.image)
+
+    def remove(self, platforms):
+        """
+        Take platforms out of the level, which releases their images.
+        """
+        freed = len(platforms) * PLATFORM_OVERHEAD_BYTES
+        for platform in platforms:
+            self.app.remove_platform(platform)
+            freed += self.drop_image(platform)
+        self.used -= freed
+
+    def unload(self, index):
+        self.remove(self.loaded.pop(index))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("chunk unloaded index=%d", index)
+
+    def distance(self, index, view_rect):
+        left = index * self.chunk_width
+        right = left + self.chunk_width
+        return max(left - view_rect.right, view_rect.left - right, 0)
+
+    def update(self, view_rect):
+        """
+        Load what is near view_rect and unload what is far from it.
+        """
+        for index in self.chunk_range(view_rect.left - self.load_distance,
+                                      view_rect.right + self.load_distance):
+            if index in self.loaded:
+                continue
+            if self.loader is None or not self.distance(index, view_rect):
+                if index in self.building:
+                    self.finish_building(index)
+                else:
+                    self.load(index, self.read_chunk(index))
+            elif index not in self.pending and index not in self.building:
+                self.pending.add(index)
+                self.loader.submit(lambda data, index=index: self.loaded_in_background(index, data),
+                                   self.read_chunk, index,
+                                   error=lambda error, index=index: self.failed_in_background(index, error))
+        for index in [i for i in self.loaded if self.distance(i, view_rect) > self.unload_distance]:
+            self.unload(index)
+        for index in [i for i in self.building if self.distance(i, view_rect) > self.unload_distance]:
+            self.abandon(index)
+        if self.used > self.budget:
+            self.enforce_budget(view_rect)
+
+    def enforce_budget(self, view_rect):
+        """
+        Unload the chunks farthest from the view until we are within budget,
+        never touching the ones the view is in.
+        """
+        for index in sorted(self.loaded, key=lambda i: self.distance(i, view_rect), reverse=True):
+            if self.used <= self.budget or not self.distance(index, view_rect):
+                break
+            self.unload(index)
+        if self.used > self.budget:
+            log.warning("level chunks over budget used=%d budget=%d", self.used, self.budget)
+
+
+class DirtyRectRenderer(object):
+    """
+    Draws a frame but only pushes the regions that changed since the last one
+    to the display. The sprites are blitted in one batch which returns the
+    rect each of them covers, so we can compare it against the rect it
+    occupied on the previous frame.
+    """
+    def __init__(self, screen, clear, profiler):
+        self.screen = screen
+        self.clear = clear
+        self.profiler = profiler
+        self.last_rects = {}
+        self.full_redraw = True
+
+    def invalidate(self):
+        """
+        Force the next frame to push the whole screen.
+        """
+        self.full_redraw = True
+
+    def draw(self, entities, overlay):
+        """
+        Erase where the entities were last frame, redraw everything and update
+        only the rects that differ. Sprites are opaque so redrawing one that
+        did not move gives identical pixels, but the overlay is translucent and
+        is always erased before it is drawn again. The overlay is None while
+        it is hidden.
+        """
+        screen = self.screen
+        if self.full_redraw:
+            self.clear()
+        else:
+            for rect in self.last_rects.values():
+                self.clear(rect)
+        overlay_rect = self.last_rects.get(overlay)
+        dirty = []
+        current = {}
+        rects = screen.blits([entity.blit_item() for entity in entities])
+        for entity, rect in zip(entities, rects):
+            old = self.last_rects.get(entity)
+            if old != rect:
+                dirty.append(rect)
+                if old is not None:
+                    dirty.append(old)
+            current[entity] = rect
+        for entity, old in self.last_rects.items():
+            if entity not in current and entity is not overlay:
+                dirty.append(old)
+        if overlay is not None:
+            start = self.profiler.begin()
+            rect = overlay.draw(screen)
+            self.profiler.end("DebugOverlay.draw", start)
+            if overlay_rect != rect or overlay.dirty or rect.collidelist(dirty) != -1:
+                dirty.append(rect)
+                if overlay_rect is not None:
+                    dirty.append(overlay_rect)
+            overlay.dirty = False
+            current[overlay] = rect
+        self.last_rects = current
+        start = self.profiler.begin()
+        if self.full_redraw:
+            self.full_redraw = False
+            pg.display.update()
+        elif dirty:
+            pg.display.update(dirty)
+        self.profiler.end("display.update", start)
+
+
 class App(object):
     """
     Class responsible for program control flow.
     """
-    def __init__(self):
+    def __init__(self, dirty_rects=DIRTY_RECTS, tick_rate=PHYSICS_TICK_RATE, level=LEVEL,
+                 static_layer=STATIC_LAYER, entity_store=ENTITY_STORE, level_path=None,
+                 atlas=ATLAS):
         self.screen = pg.display.get_surface()
         self.screen_rect = self.screen.get_rect()
         self.clock = pg.time.Clock()
         self.font = pg.font.SysFont('Consolas', 14)
         self.fps = FPS
+        self.tick_rate = tick_rate
         self.start_time = time.time()
         self.final_time = 0
         self.time_now = self.start_time
         self.done = False
         self.keys = pg.key.get_pressed()
-        self.player = Player(self, vector(300, 200), SPRITE_SIZE, (255, 0, 0), SPRITE_VELOCITY)
-        self.camera = Camera(VIRTUAL_SCREEN_SIZE, self.player)
-        self.platform1 = Platform(self.camera, vector(SCREEN_SIZE[0], 10), (SCREEN_SIZE[0], SCREEN_SIZE[1] - 10), (100, 100, 200))
-        self.platform2 = Platform(self.camera, vector(200, 10), (SCREEN_SIZE[0]-200, 300), (100, 100,200))
+        self.tick_count = 0
+        self.actor_keys = {}  # keys held for actors not played on this keyboard
+        self.session = None
+        self.recorder = None
+        self.resimulating = False  # ticks simulated again by a rollback are not recorded twice
+        self.atlas = SpriteAtlas() if atlas else None
+        self.streamer = None
+        self.loader = AsyncLoader() if ASYNC_LOADING else None
+        spawn = vector(300, 200)
+        if level_path is not None:
+            self.streamer = ChunkStreamer(self, open_level(level_path), loader=self.loader)
+            if self.streamer.level.spawns:
+                spawn = vector(self.streamer.level.spawns[0])
+            level = ()
+        self.player = Player(self, spawn, SPRITE_SIZE, (255, 0, 0), SPRITE_VELOCITY)
+        self.camera = Camera(self.streamer.size if self.streamer else VIRTUAL_SCREEN_SIZE, self.player)
         self.all_platforms = pg.sprite.Group()
-        self.all_platforms.add(self.platform1)
-        self.all_platforms.add(self.platform2)
+        self.platform_index = SpatialHash(PLATFORM_INDEX_CELL_SIZE)
+        self.collision = SpatialHash(PLATFORM_INDEX_CELL_SIZE)
+        self.region_platforms = {}  # collision region -> {platform: None}, in the order added
+        self.region_boxes = {}  # collision region -> its compiled CollisionBoxes
+        self.region_bounds = {}  # collision region -> its boxes as an array, built when asked for
+        self.dirty_regions = set()
         self.all_sprites = pg.sprite.Group()
-        self.all_sprites.add(self.player)
-        self.all_sprites.add(self.platform1)
-        self.all_sprites.add(self.platform2)
-        self.debug_overlay = DebugOverlay((0, 0), DEBUG_OVERLAY_SIZE, DEBUG_OVERLAY_BACKGROUND_COLOR, self.player)
+        self.actors = pg.sprite.Group()
+        self.entity_store = EntityStore() if entity_store else None
+        self.add_actor(self.player)
+        self.static_layer = None
+        if static_layer:
+            self.static_layer = StaticLayer(self.platform_index, BACKGROUND_COLOR)
+        self.last_view = None
+        for size, position, color in level:
+            self.add_platform(Platform(self.camera, size, position, color, self.atlas))
+        if self.streamer:
+            self.streamer.update(self.camera.simulation_rect())
+        self.frame_stats = FrameStats(self.fps)
+        self.debug_overlay = DebugOverlay((0, 0), DEBUG_OVERLAY_SIZE, DEBUG_OVERLAY_BACKGROUND_COLOR, self.player, self.frame_stats)
+        self.show_overlay = DEBUG_OVERLAY
+        self.profiler = FrameProfiler()
+        self.renderer = None
+        if dirty_rects:
+            self.renderer = DirtyRectRenderer(self.screen, self.draw_background, self.profiler)
+        self.snapshots = None
+        if SNAPSHOT_HISTORY:
+            self.snapshots = SnapshotRing(self)
+            self.snapshots.save()
+
+    def add_actor(self, actor):
+        """
+        Add a moving sprite, integrated by the entity store when there is one.
+        """
+        self.all_sprites.add(actor)
+        self.actors.add(actor)
+        if self.entity_store is not None:
+            actor.bind(self.entity_store)
+
+    def add_platform(self, platform):
+        """
+        Add a platform to the level. The collision boxes of the regions it
+        lies in are compiled again the next time collisions are asked for.
+        """
+        self.all_platforms.add(platform)
+        self.all_sprites.add(platform)
+        self.platform_index.insert(platform, platform.world_rect)
+        for region in self.collision_regions(platform.world_rect):
+            self.region_platforms.setdefault(region, {})[platform] = None
+            self.dirty_regions.add(region)
+        if self.static_layer:
+            self.static_layer.invalidate(platform.world_rect)
+
+    def close(self):
+        """
+        Let go of what the App holds beyond its own objects: the images its
+        platforms share through SURFACES and the loader's threads. The App
+        is not to be used afterwards.
+        """
+        for platform in self.all_platforms.sprites():
+            platform.kill()
+            platform.release()
+        if self.loader:
+            self.loader.shutdown()
+
+    def remove_platform(self, platform):
+        self.platform_index.remove(platform)
+        platform.kill()
+        platform.release()
+        for region in self.collision_regions(platform.world_rect):
+            del self.region_platforms[region][platform]
+            self.dirty_regions.add(region)
+        if self.static_layer:
+            self.static_layer.invalidate(platform.world_rect)
+
+    def collision_regions(self, rect):
+        """
+        The columns of COLLISION_REGION_WIDTH world pixels rect lies in.
+        """
+        width = COLLISION_REGION_WIDTH
+        return range(rect.left // width, (rect.right - 1) // width + 1)
+
+    def collision_index(self):
+        """
+        A spatial hash of the level's merged collision boxes. They are
+        compiled one region at a time, from the platforms cut to the region,
+        and only the regions whose platforms changed are compiled again.
+        """
+        if self.dirty_regions:
+            for region in self.dirty_regions:
+                self.compile_region(region)
+            self.dirty_regions.clear()
+        return self.collision
+
+    def collision_bounds(self, left, right):
+        """
+        The collision boxes of the regions from world x left to right as an
+        array of (left, top, right, bottom) rows, for vectorized tests.
+        """
+        self.collision_index()
+        width = COLLISION_REGION_WIDTH
+        arrays = []
+        for region in range(int(left // width), int(right // width) + 1):
+            bounds = self.region_bounds.get(region)
+            if bounds is None:
+                boxes = self.region_boxes.get(region)
+                if not boxes:
+                    continue
+                bounds = self.region_bounds[region] = np.array(
+                    [(box.world_rect.left, box.world_rect.top, box.world_rect.right, box.world_rect.bottom)
+                     for box in boxes], float)
+            arrays.append(bounds)
+        return np.concatenate(arrays) if arrays else np.zeros((0, 4))
+
+    def compile_region(self, region):
+        self.region_bounds.pop(region, None)
+        for box in self.region_boxes.pop(region, ()):
+            self.collision.remove(box)
+        platforms = self.region_platforms.get(region)
+        if not platforms:
+            self.region_platforms.pop(region, None)
+            return
+        left = region * COLLISION_REGION_WIDTH
+        right = left + COLLISION_REGION_WIDTH
+        rects = []
+        for platform in platforms:
+            rect = platform.world_rect
+            piece_left = max(rect.left, left)
+            rects.append(pg.Rect(piece_left, rect.top, min(rect.right, right) - piece_left, rect.height))
+        boxes = [CollisionBox(rect) for rect in compile_collision_rects(rects)]
+        for box in boxes:
+            self.collision.insert(box, box.world_rect)
+        self.region_boxes[region] = boxes
 
     def event_loop(self):
         """
@@ -277,45 +2286,366 @@ class App(object):
                 self.done = True
             elif event.type in (pg.KEYDOWN, pg.KEYUP):
                 self.keys = pg.key.get_pressed()
+                if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                    self.show_overlay = not self.show_overlay
+                    if self.renderer:
+                        self.renderer.invalidate()
+                elif event.type == pg.KEYDOWN and event.key == pg.K_F8:
+                    self.profiler.enabled = not self.profiler.enabled
+                elif event.type == pg.KEYDOWN and event.key == pg.K_F9:
+                    self.profiler.export_chrome_trace()
 
     def update(self, dt):
         """
-        Update all the sprites
+        Update the actors. Platforms are static, so they are never stepped.
         """
-        for entity in self.all_sprites:
-            entity.update(self.keys, self.screen_rect, self.camera, dt)
-        self.camera.update(self.player)        
-        self.debug_overlay.update(self.keys, self.screen_rect, dt)
+        profiler = self.profiler
+        update_start = profiler.begin()
+        if self.recorder is not None and not self.resimulating:
+            self.recorder.record(self.keys)
+        if self.streamer:
+            start = profiler.begin()
+            self.streamer.update(self.camera.simulation_rect())
+            profiler.end("ChunkStreamer.update", start)
+        actor_keys = self.actor_keys
+        store = self.entity_store
+        if store is None:
+            for entity in self.actors:
+                start = profiler.begin()
+                keys = actor_keys.get(entity, self.keys) if actor_keys else self.keys
+                entity.update(keys, self.screen_rect, self.camera, dt)
+                profiler.end(type(entity).__name__, start)
+        else:
+            start = profiler.begin()
+            store.control(self.keys, actor_keys, self.camera)
+            store.step(dt)
+            profiler.end("EntityStore.step", start)
+            start = profiler.begin()
+            store.resolve(self.screen_rect, self.camera, self.collision_bounds)
+            profiler.end("EntityStore.resolve", start)
+        start = profiler.begin()
+        self.camera.update(self.player, dt)
+        profiler.end("Camera.update", start)
+        self.tick_count += 1
+        if self.snapshots is not None:
+            start = profiler.begin()
+            self.snapshots.save()
+            profiler.end("SnapshotRing.save", start)
+        if self.show_overlay:
+            self.debug_overlay.update(self.keys, self.screen_rect, dt)
+        profiler.end("App.update", update_start)
 
-    def draw(self):
+    def visible_entities(self, view_rect):
         """
-        Basic draw function.
+        The actors followed by the platforms the camera can see. Platforms come
+        from the spatial index so off-screen ones are never looked at, and
+        static ones are left out when the static layer already has them.
+        """
+        entities = self.actors.sprites()
+        platforms = self.platform_index.query(view_rect)
+        if self.static_layer:
+            platforms = [platform for platform in platforms if not platform.static]
+        entities.extend(platforms)
+        return entities
+
+    def draw_background(self, rect=None):
+        """
+        Draw what lies behind the sprites, on the whole screen or just rect.
+        """
+        if self.static_layer:
+            self.static_layer.draw(self.screen, self.camera.view_rect(), rect)
+        else:
+            self.screen.fill(BACKGROUND_COLOR, rect)
+
+    def draw(self, alpha=1.0):
         """
-        self.screen.fill(BACKGROUND_COLOR)
-        for entity in self.all_sprites:
-            entity.draw(self.screen)
-        self.debug_overlay.draw(self.screen)
+        Basic draw function. alpha is how far we are between the previous
+        and the current physics tick.
+        """
+        profiler = self.profiler
+        draw_start = profiler.begin()
+        for actor in self.actors:
+            actor.interpolate(alpha)
+        self.camera.interpolate(alpha)
+        view_rect = self.camera.view_rect()
+        entities = self.visible_entities(view_rect)
+        if self.renderer:
+            if self.static_layer and view_rect != self.last_view:
+                self.renderer.invalidate()
+            self.last_view = view_rect
+            self.renderer.draw(entities, self.debug_overlay if self.show_overlay else None)
+            profiler.end("App.draw", draw_start)
+            return
+        self.draw_background()
+        blit_all(self.screen, [entity.blit_item() for entity in entities], self.atlas is not None)
+        if self.show_overlay:
+            start = profiler.begin()
+            self.debug_overlay.draw(self.screen)
+            profiler.end("DebugOverlay.draw", start)
+        start = profiler.begin()
         pg.display.update()
+        profiler.end("display.update", start)
+        profiler.end("App.draw", draw_start)
+
+    def run_headless(self, steps, inputs=(), render=False):
+        """
+        Step the world steps times as fast as possible, with no clock and no
+        events. inputs yields the keys held for each tick (a ScriptedKeys or
+        any collection of pg key constants); once it runs out nothing is held.
+        """
+        inputs = iter(inputs)
+        for _ in range(steps):
+            self.step(next(inputs, NO_KEYS))
+            if render:
+                self.draw()
+        return steps
+
+    def step(self, keys):
+        """
+        Advance the world by one physics tick with keys held.
+        """
+        if not isinstance(keys, ScriptedKeys):
+            keys = ScriptedKeys(keys)
+        self.keys = keys
+        self.drain_loader()
+        self.update(1.0 / self.tick_rate)
+
+    def drain_loader(self):
+        """
+        Take in whatever the background loader has finished, within its budget.
+        """
+        if self.loader:
+            start = self.profiler.begin()
+            self.loader.drain()
+            self.profiler.end("AsyncLoader.drain", start)
+
+    def state_size(self):
+        """
+        Bytes needed by save_state.
+        """
+        return WORLD_STATE.size + CAMERA_STATE.size + ACTOR_STATE.size * len(self.actors)
+
+    def save_state(self, buffer):
+        """
+        Pack the tick count, the camera and every actor into buffer, which
+        must be at least state_size() bytes. Platforms never move, so they
+        are left out.
+        """
+        WORLD_STATE.pack_into(buffer, 0, self.tick_count, len(self.actors))
+        offset = WORLD_STATE.size
+        self.camera.save_state(buffer, offset)
+        offset += CAMERA_STATE.size
+        for actor in self.actors:
+            actor.save_state(buffer, offset)
+            offset += ACTOR_STATE.size
+
+    def load_state(self, buffer):
+        """
+        Restore the world from a buffer filled by save_state.
+        """
+        tick_count, actors = WORLD_STATE.unpack_from(buffer, 0)
+        if actors != len(self.actors):
+            raise ValueError("state holds %d actors, the world has %d" % (actors, len(self.actors)))
+        self.tick_count = tick_count
+        offset = WORLD_STATE.size
+        self.camera.load_state(buffer, offset)
+        offset += CAMERA_STATE.size
+        for actor in self.actors:
+            actor.load_state(buffer, offset)
+            offset += ACTOR_STATE.size
+
+    def rewind(self, ticks):
+        """
+        Go back ticks ticks, or as far as the snapshot history reaches.
+        """
+        tick = self.tick_count - ticks
+        while tick not in self.snapshots and tick < self.tick_count:
+            tick += 1
+        self.snapshots.restore(tick)
+
+    def observe(self):
+        """
+        The player's position, velocity and whether it is on a platform.
+        """
+        player = self.player
+        return (player.position.x, player.position.y,
+                player.velocity.x, player.velocity.y, player.on_platform)
 
     def game_loop(self):
         """
-        Simple game loop where we use the return value of the call to self.clock.tick
-        to get the time delta between frames and pass it to all our sprites.
+        Fixed timestep game loop. The time returned by self.clock.tick is
+        added to an accumulator which is consumed in fixed physics ticks, and
+        the remainder is used to interpolate what we draw between the last two
+        physics states.
         """
-        dt = 0
+        tick = 1.0 / self.tick_rate
+        accumulator = 0.0
+        profiler = self.profiler
         self.clock.tick(self.fps)
         while not self.done:
+            start = profiler.begin()
             self.event_loop()
-            self.update(dt)
-            self.draw()
-            dt = self.clock.tick(self.fps) / 1000.0
+            profiler.end("App.event_loop", start)
+            self.drain_loader()
+            ticks = 0
+            while accumulator >= tick:
+                if self.session is not None:
+                    self.session.advance(self.keys)
+                else:
+                    self.update(tick)
+                accumulator -= tick
+                ticks += 1
+                if ticks == MAX_TICKS_PER_FRAME:
+                    accumulator = 0.0
+            self.draw(accumulator / tick)
+            start = profiler.begin()
+            frame_time = self.clock.tick(self.fps) / 1000.0
+            profiler.end("clock.tick", start)
+            self.frame_stats.record(frame_time)
+            accumulator += min(frame_time, MAX_FRAME_TIME)
 
-def main():
-    os.environ['SDL_VIDEO_CENTERED'] = '1'
+def init_headless():
+    """
+    Initialise pygame with the SDL dummy video driver, so an App can be
+    created and stepped without opening a window.
+    """
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
     pg.init()
-    pg.display.set_caption(CAPTION)
     pg.display.set_mode(SCREEN_SIZE)
-    App().game_loop()
+
+
+def simulate_world(job):
+    """
+    Run one headless world and return an observation for every tick.
+    job is (inputs, steps, level), see App.run_headless for inputs.
+    """
+    inputs, steps, level = job
+    app = App(level=level)
+    inputs = iter(inputs)
+    observations = []
+    try:
+        for _ in range(steps):
+            app.step(next(inputs, NO_KEYS))
+            observations.append(app.observe())
+    finally:
+        app.close()
+    return observations
+
+
+class WorldPool(object):
+    """
+    Runs independent headless worlds in parallel, one per worker process.
+    """
+    def __init__(self, processes=None):
+        self.pool = multiprocessing.Pool(processes, initializer=init_headless)
+
+    def run(self, input_streams, steps, levels=None):
+        """
+        Simulate one world per input stream for steps ticks. levels gives
+        each world its own level, otherwise they all use LEVEL. Returns the
+        observations of every world, in the order of input_streams.
+        """
+        if levels is None:
+            levels = [LEVEL] * len(input_streams)
+        jobs = [(list(inputs), steps, level) for inputs, level in zip(input_streams, levels)]
+        return self.pool.map(simulate_world, jobs)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def loss_fraction(text):
+    """
+    Parse a --loss FRACTION; all packets lost would never finish a match.
+    """
+    loss = float(text)
+    if not 0 <= loss < 1:
+        raise argparse.ArgumentTypeError("%s is not at least 0 and below 1" % text)
+    return loss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=CAPTION)
+    parser.add_argument("--headless", type=int, metavar="STEPS",
+                        help="step the world STEPS times with no window and exit")
+    parser.add_argument("--level", metavar="PATH",
+                        help="stream a %s level file or a write_level directory" % LEVEL_EXTENSION)
+    parser.add_argument("--convert-level", nargs=2, metavar=("SOURCE", "DEST"),
+                        help="convert a JSON level to the binary format and exit")
+    parser.add_argument("--record", metavar="PATH",
+                        help="save the keys held on every tick to PATH on exit")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="replay a recording headless as fast as possible and exit")
+    parser.add_argument("--netplay", type=int, choices=(0, 1), metavar="PLAYER",
+                        help="play as player 0 or 1 against another instance on this machine")
+    parser.add_argument("--loopback", type=int, metavar="TICKS",
+                        help="play two rollback clients against each other headless and exit")
+    parser.add_argument("--latency", type=float, default=NET_LATENCY * 1000, metavar="MS",
+                        help="hold back every packet sent by MS milliseconds")
+    parser.add_argument("--loss", type=loss_fraction, default=NET_LOSS, metavar="FRACTION",
+                        help="drop this fraction of the packets sent")
+    args = parser.parse_args()
+    if args.record and args.netplay is not None:
+        parser.error("--record saves only the local keys, so a netplay session cannot be replayed")
+    configure_logging()
+    if args.convert_level:
+        convert_level(*args.convert_level)
+        sys.exit()
+    if args.loopback is not None:
+        init_headless()
+        start = time.perf_counter()
+        sessions = run_loopback_match(args.loopback, args.latency / 1000, args.loss)
+        elapsed = time.perf_counter() - start
+        states = []
+        for session in sessions:
+            state = bytearray(session.app.state_size())
+            session.app.save_state(state)
+            states.append(state)
+            print("player %d: %d rollbacks, %d ticks simulated again, %d stalls, %d/%d packets dropped"
+                  % (session.local, session.rollbacks, session.resimulated, session.stalls,
+                     session.peer.dropped, session.peer.sent))
+            session.app.close()
+        print("%d ticks in %.3fs, worlds match: %s" % (args.loopback, elapsed, states[0] == states[1]))
+        pg.quit()
+        sys.exit(0 if states[0] == states[1] else 1)
+    if args.headless is not None or args.replay:
+        init_headless()
+        tick_rate, inputs = PHYSICS_TICK_RATE, ()
+        steps = args.headless
+        if args.replay:
+            tick_rate, inputs = load_replay(args.replay, args.level)
+            steps = len(inputs)
+        app = App(tick_rate=tick_rate, level_path=args.level)
+        if args.record:
+            app.recorder = InputRecorder(app.tick_rate, args.level)
+        start = time.perf_counter()
+        app.run_headless(steps, inputs)
+        elapsed = time.perf_counter() - start
+        print("%d steps in %.3fs (%.0f steps/s)" % (steps, elapsed, steps / max(elapsed, 1e-9)))
+        print("player x=%r y=%r vx=%r vy=%r on_platform=%r" % app.observe())
+    else:
+        os.environ['SDL_VIDEO_CENTERED'] = '1'
+        pg.init()
+        pg.display.set_caption(CAPTION)
+        pg.display.set_mode(SCREEN_SIZE)
+        app = App(level_path=args.level)
+        if args.record:
+            app.recorder = InputRecorder(app.tick_rate, args.level)
+        if args.netplay is not None:
+            peer = LoopbackPeer(NET_PORT + args.netplay, args.latency / 1000, args.loss)
+            peer.connect(("127.0.0.1", NET_PORT + 1 - args.netplay))
+            app.session = RollbackSession(app, peer, args.netplay)
+        app.game_loop()
+    if args.record:
+        app.recorder.save(args.record)
+    app.close()
     pg.quit()
     sys.exit()
 